@@ -1,4 +1,5 @@
 import asyncio
+import json
 from operator import truediv
 import random
 import websockets
@@ -6,14 +7,26 @@ from websockets.exceptions import ConnectionClosed
 import os
 import time
 import re
+from typing import Optional
 from log import info,debug,warning,error
-from llm.if_module import llm_if
-from llm.send_message import llm_send_message
+from llm.if_module import llm_if, llm_if_batch
+from llm.send_message import llm_send_message, outbound_queue, 含敏感词, 替换回复
 from read_config import load_adapter_config,load_bot_config,load_adaptive_model_config
 from config.errors import ConfigError, ConfigErrorBundle
 from type_analysis import parse_msg
 from data.read_the_username import 替换消息中的at
+from data import read_the_username
 from llm.Image_recognition import 图片识别
+from llm import client_pool, image_download, image_preprocess
+from llm.prompt_builder import 构建历史, 计算token数
+from llm import interest_model
+import metrics
+from data import image_cache
+from data.context_store import ContextEntry, ContextStore
+from pipeline import GroupEvent, GroupPipeline
+from scheduler import ReplyScheduler
+from repeat_cache import JudgeScoreCache, RepeatTracker, 上下文指纹, 适合跟读
+from onebot import action_client
 
 
 adapter_config = {}
@@ -42,8 +55,20 @@ maxtoken = 0
 group_last_call_time = {}
 
 # 群聊上下文记录
-group_context = {}  # 存储每个群聊的消息历史
+群聊上下文: ContextStore = ContextStore(persist=False)  # 每个群聊的消息历史，main 中按配置重建
 消息记录长度 = 15 # 默认值，稍后从配置更新
+判断token预算 = 600 # 判断模型聊天记录的 token 上限，稍后从配置更新
+回复token预算 = 2000 # 回复模型聊天记录的 token 上限，稍后从配置更新
+单条token上限 = 200 # 单条消息超过这个长度会被截断，稍后从配置更新
+复读追踪 = RepeatTracker()
+判断缓存 = JudgeScoreCache()
+复读开关 = True
+跟读阈值 = 0 # 复读到第几条时跟读一次，0为不跟读，稍后从配置更新
+推测开关 = True
+流式回复 = True
+回复最大字数 = 120 # 流式回复超过这个字数就截断，稍后从配置更新
+推测并发 = None # 同时进行的推测回复数量，稍后从配置创建
+图片识别超时 = 60 # 后台图片识别的最长时间，稍后从配置更新
 
 personality_core = ""
 personality_side = ""
@@ -52,16 +77,36 @@ identity = ""
 提示词 = ""
 
 第一次连接=True
-#为防止无法访问局部变量的报错，定义一个全局变量在这里
-回复=False
+# 当前的 NapCat 连接，断线重连后由 main 更新，供流水线各阶段使用
+当前连接 = None
+流水线 = None
+图片识别并发 = None
+每条消息图片并发 = 2 # 稍后从配置更新
+
+
+class 图片占位:
+    """消息中的一张图片，先以占位加入上下文，后台识别完成后原地补上描述。"""
+
+    def __init__(self, 链接: str, 文件名: str = ""):
+        self.链接 = 链接
+        self.文件名 = 文件名
+        self.描述 = None
+        self.pending = False  # 正在后台识别，上下文写回会等它结束
+
+    def __str__(self):
+        if self.描述:
+            return f"[图片:{self.描述}]"
+        return "[图片]"
+
 
 async def main():
-    global 回复
-    global 第一次连接
+    global 第一次连接, 当前连接, 流水线, 图片识别并发, 每条消息图片并发, 群聊上下文
     global adapter_config, bot_config, adaptive_model_config
     global host, port, bot_name, bot_qq, reply_interest, 替换词, 被替换词
+    global 流式回复, 回复最大字数
     global maxtoken, 回复模型_url, 回复模型_key, 回复模型_model, 判断模型_url, 判断模型_key, 判断模型_model, 图片模型_url, 图片模型_key, 图片模型_model, 图片模型_switch
-    global 消息记录长度, personality_core, personality_side, identity, 提示词
+    global 判断token预算, 回复token预算, 单条token上限, 判断缓存, 复读开关, 跟读阈值, 推测开关, 推测并发
+    global 消息记录长度, personality_core, personality_side, identity, 提示词, 图片识别超时
     try:
         adapter_config = load_adapter_config()
         bot_config = load_bot_config()
@@ -80,6 +125,8 @@ async def main():
     替换词 = bot_config['bot'].get('替换词', [])
     被替换词 = bot_config['bot'].get('被替换词', [])
     maxtoken = bot_config['model']['replyer_1']['maxtoken']
+    流式回复 = bot_config['model']['replyer_1'].get('流式', 流式回复)
+    回复最大字数 = bot_config['model']['replyer_1'].get('最大字数', 回复最大字数)
     回复模型_url = adaptive_model_config['回复模型_url']
     回复模型_key = adaptive_model_config['回复模型_key']
     回复模型_model = adaptive_model_config['回复模型_model']
@@ -92,114 +139,444 @@ async def main():
     图片模型_switch = adaptive_model_config['图片模型_switch']
     
     消息记录长度 = bot_config['bot']['消息记录长度']
+    判断token预算 = bot_config['model'].get('utils_small', {}).get('上下文token预算', 判断token预算)
+    回复token预算 = bot_config['model']['replyer_1'].get('上下文token预算', 回复token预算)
+    上下文配置 = bot_config.get('context', {})
+    单条token上限 = 上下文配置.get('单条token上限', 单条token上限)
+    复读配置 = bot_config.get('repeat', {})
+    复读开关 = 复读配置.get('开关', True)
+    跟读阈值 = 复读配置.get('跟读阈值', 跟读阈值)
+    判断缓存 = JudgeScoreCache(复读配置.get('判断缓存秒数', 300), 复读配置.get('判断缓存条数', 2048))
+    群聊上下文 = ContextStore(消息记录长度, persist=上下文配置.get('持久化', True),
+                          flush_interval=上下文配置.get('写回间隔秒数', 10))
+    群聊上下文.load()
+    图片识别超时 = bot_config['model'].get('picture', {}).get('识别超时秒数', 图片识别超时)
     personality_core = bot_config['personality']['personality_core']
     personality_side = bot_config['personality']['personality_side']
     identity = bot_config['personality']['identity']
     提示词 = (f"# 核心人格\n{personality_core}\n---\n# 侧面人格\n{personality_side}\n---\n# 固定身份\n{identity}")
 
+    # 共享的模型客户端连接池，启动时预热，避免首条消息承担建连开销
+    client_pool.configure(bot_config.get('connection_pool', {}))
+    image_download.configure(bot_config['model'].get('picture', {}))
+    image_preprocess.configure(bot_config['model'].get('picture', {}))
+    read_the_username.configure(bot_config.get('nickname', {}))
+    action_client.configure(bot_config.get('onebot', {}))
+    interest_model.configure(bot_config.get('interest_model', {}))
+    outbound_queue.configure(bot_config.get('send', {}), host, port)
+    outbound_queue.start()
+    if 图片模型_switch:
+        image_cache.configure(bot_config['model'].get('picture', {}))
+    if bot_config.get('connection_pool', {}).get('启动预热', True):
+        await client_pool.warmup(adaptive_model_config)
+
+    流水线配置 = bot_config.get('pipeline', {})
+    图片识别并发 = asyncio.Semaphore(max(1, 流水线配置.get('图片并发', 4)))
+    每条消息图片并发 = max(1, 流水线配置.get('每条消息图片并发', 每条消息图片并发))
+    调度配置 = bot_config.get('scheduler', {})
+    回复调度 = ReplyScheduler(
+        concurrency=调度配置.get('回复并发', 4),
+        rate=调度配置.get('每群每秒回复数', 0.2),
+        burst=调度配置.get('每群突发回复数', 2),
+        weights={int(群): 权重 for 群, 权重 in 调度配置.get('群权重', {}).items()},
+    )
+    回复调度.start()
+    推测开关 = 调度配置.get('推测回复', True)
+    推测并发 = asyncio.Semaphore(max(1, 调度配置.get('推测并发', 2)))
+    流水线 = GroupPipeline(
+        丰富消息, 判断兴趣, 回复群消息, 回复调度,
+        queue_size=流水线配置.get('每群队列长度', 50),
+        enrich_concurrency=流水线配置.get('预处理并发', 8),
+        judge_concurrency=流水线配置.get('判断并发', 8),
+        reply_deadline=调度配置.get('回复截止秒数', 60),
+        judge_batch_size=流水线配置.get('批量判断条数', 5),
+        judge_batch_window=流水线配置.get('批量判断窗口秒数', 0),
+        debounce_gap=流水线配置.get('合并间隔秒数', 0),
+        debounce_max_wait=流水线配置.get('合并最长等待秒数', 5),
+        max_newer_messages=调度配置.get('最多落后消息数', 10),
+        supersede=调度配置.get('取代旧回复', True),
+        degrade_depth=流水线配置.get('降级积压条数', 10),
+        degrade_age=流水线配置.get('降级等待秒数', 15),
+        shed_depth=流水线配置.get('丢弃积压条数', 30),
+        judge_deadline=流水线配置.get('判断截止秒数', 30),
+    )
+
+    # 群成员昵称在连接时批量预热，之后定期刷新
+    昵称配置 = bot_config.get('nickname', {})
+    昵称刷新间隔 = 昵称配置.get('预热刷新间隔秒数', 21600)
+    指标输出间隔 = bot_config.get('metrics', {}).get('输出间隔秒数', 600)
+    if 指标输出间隔 > 0:
+        流水线.spawn(metrics.定期输出(指标输出间隔))
+    if 昵称刷新间隔 > 0:
+        流水线.spawn(read_the_username.定期预热群成员昵称(adapter_config['chat']['group_list'], 昵称配置.get('预热并发', 2), 昵称刷新间隔))
+
     uri = f"ws://{host}:{port}/"
     
-    while True:
-        try:
-            async with websockets.connect(uri) as websocket:
-                if 第一次连接:
-                    info(f"已连接到 {uri}")
-                    第一次连接=False
-                else:
-                    info(f"重新连接到 {uri}")
-                async for message in websocket:
-                     parsed = parse_msg(message)
-                     if parsed is None:
-                         continue
-                     
-                     消息类型, 消息内容, 群号, 人名 = parsed
-                      
-                     # 检查群号是否在白名单中
-                     if 群号 not in adapter_config['chat']['group_list']:
-                         continue  # 如果群号不在白名单中，跳过处理，等待下一条消息
-                     if 消息类型=="图片":
-                         if 图片模型_switch:
+    try:
+        while True:
+            try:
+                async with websockets.connect(uri) as websocket:
+                    当前连接 = websocket
+                    action_client.bind(websocket)
+                    try:
+                        if 第一次连接:
+                            info(f"已连接到 {uri}")
+                            第一次连接=False
+                        else:
+                            info(f"重新连接到 {uri}")
+                        if 昵称配置.get('启动预热', True):
+                            流水线.spawn(read_the_username.预热群成员昵称(adapter_config['chat']['group_list'], 昵称配置.get('预热并发', 2)))
+                        # 读取循环只负责解码和分发，耗时的处理都在流水线中进行
+                        async for message in websocket:
                             try:
-                                图片描述 = await asyncio.wait_for(图片识别(消息内容, 图片模型_key, 图片模型_url, 图片模型_model), timeout=10)
-                                # 日志输出在这个函数内部
-                                消息内容 = f"[图片:{图片描述}]"
-                                回复=False
-                            except asyncio.TimeoutError:
-                                warning("图片识别线程长时间不返回内容，直接跳过")
-                                消息内容 = "[图片]"
-                            except Exception as e:
-                                error(f"图片识别出错: {e}")
-                                消息内容 = "[图片]"
-                         else:
-                             消息内容 = "[图片]"
-                     elif 消息类型=="文件":
-                         消息内容=f"[文件]"
-              
-                     # 只要消息中包含 @后跟5~12位数字，就执行一次替换（可能有多个@数字会统一处理）
-                     # 处理 @QQ -> @昵称 并判断是否被@
-                     try:
-                         if re.search(r"@\d{5,12}", 消息内容):
-                             消息内容 = await 替换消息中的at(消息内容, host, port, bot_qq=bot_qq, bot_name=bot_name, 群号=群号, websocket=websocket)
-                     except Exception as e:
-                         warning(f"处理@用户名时出错: {e}")
-                     # 为每个群聊维护独立的上下文记录
-                     if 群号 not in group_context:
-                         group_context[群号] = []  # 初始化该群的消息历史
-                     # 添加当前消息到群聊上下文（格式："用户名: 消息内容"）
-                     current_message = f"{人名}: {消息内容}"
-                     group_context[群号].append(current_message)
-                     
-                     # 保持消息历史长度不超过配置的限制
-                     if len(group_context[群号]) > 消息记录长度:
-                         group_context[群号] = group_context[群号][-消息记录长度:]  # 保留最新的N条消息
-                      
-                     if 消息类型=="文字":
-                        回复=True
-                     else:
-                        回复=False
-                     #触发事件:回复
-                     if 回复:
-                         最近五条 = "\n".join(group_context.get(群号, [])[-5:])
-                         try:
-                             兴趣 = await llm_if((f"""{人名}发了消息:{消息内容}"""), bot_name, bot_qq, 判断模型_url, 判断模型_key, 判断模型_model, 消息内容, 提示词, 消息记录=最近五条)
-                             if 兴趣 == "error:0":
-                                 warning("判断错误0:判断模型返回值为空")
-                                 兴趣=0
-                             elif 兴趣 == "error:1":
-                                 warning("判断错误1:ValueError")
-                                 兴趣=0
-                         except Exception as e:
-                             warning(f"判断模型出错: {e}")
-                         info(f"收到来自{群号}的{人名}消息: {消息内容}。兴趣度:{兴趣}")
-                         if 兴趣>=reply_interest:                         
-                             async def 回复群消息(ws):
-                                 try:
-                                     # 使用该群的完整消息历史作为上下文
-                                     群消息历史 = "\n".join(group_context[群号])
-                                     单条完整消息=f"{人名}发了: {消息内容}"
-                                     回复内容=await llm_send_message(消息历史=[群消息历史],单条完整消息=单条完整消息,那个人的名字=人名,bot名字=bot_name,提示词=提示词,群号=群号,napcat_host=host,napcat_port=port,api_url=回复模型_url,api_key=回复模型_key,模型=回复模型_model,是否发至群里=True,最大token=maxtoken,替换词=替换词, 被替换词=被替换词, websocket=ws)
-                                     debug(f"发给判断模型的消息历史:{群消息历史}")
-                                     # 将bot的回复也添加到群聊上下文中
-                                     if 回复内容:
-                                         bot_message = f"{bot_name}: {回复内容}"
-                                         group_context[群号].append(bot_message)
-                                         # 再次检查长度限制
-                                         if len(group_context[群号]) > 消息记录长度:
-                                             group_context[群号] = group_context[群号][-消息记录长度:]
-                                 except Exception as e:
-                                    if str(e).isdigit() and 9 <= len(str(e)) <= 10:
-                                        pass  # 如果是9-10位数字则忽略
-                                    else:
-                                        error(f"回复模型出错: {e}")
-                             asyncio.create_task(回复群消息(websocket))
-                            
-        except ConnectionClosed:
-            warning("WebSocket连接已关闭，尝试重新连接...")
-            await asyncio.sleep(5)  # 等待5秒后重新连接
+                                数据 = json.loads(message)
+                            except ValueError:
+                                continue
+                            # 动作请求的响应直接交给等待中的调用方
+                            if action_client.handle_response(数据):
+                                continue
+                            # 白名单群有新成员时立即缓存其昵称
+                            if 数据.get("post_type") == "notice" and 数据.get("notice_type") == "group_increase":
+                                if 数据.get("group_id") in adapter_config['chat']['group_list']:
+                                    流水线.spawn(read_the_username.刷新成员昵称(数据.get("group_id"), 数据.get("user_id"), host, port))
+                                continue
+                            parsed = parse_msg(数据)
+                            if parsed is None:
+                                continue
+                            消息类型, 消息内容, 群号, 人名, 消息段 = parsed
+                            # 检查群号是否在白名单中
+                            if 群号 not in adapter_config['chat']['group_list']:
+                                continue
+                            # 过载时@机器人的消息优先保留，判断阶段还会按名字再确认一次
+                            被at = bool(bot_qq) and re.search(rf"@{bot_qq}(?!\d)", 消息内容) is not None
+                            流水线.submit(GroupEvent(消息类型, 消息内容, 群号, 人名, 消息段, sender_id=int(数据.get("user_id") or 0), priority=被at))
+                    finally:
+                        action_client.unbind()
+            except ConnectionClosed:
+                warning("WebSocket连接已关闭，尝试重新连接...")
+                await asyncio.sleep(5)  # 等待5秒后重新连接
+            except Exception as e:
+                error(f"出现错误: {e}")
+                await asyncio.sleep(5)  # 等待5秒后重新连接
+    finally:
+        await 流水线.close()
+        await 回复调度.close()
+        await outbound_queue.stop()
+        await client_pool.close_all()
+        image_cache.close()
+        await 群聊上下文.close()
+        await interest_model.flush()
+        await read_the_username.flush()
+
+
+def 上下文文本(群号: int, 条数: int = 0, 预算: int = 0, 指标名: str = "", 截至=None) -> str:
+    """把群聊上下文在 token 预算内从新到旧拼成文本，条数为 0 时考虑全部记录，指定截至时只取到这条记录为止。"""
+    历史 = 构建历史([str(条目) for 条目 in 群聊上下文.last(群号, 条数, 截至)], 预算, 单条token上限)
+    if 指标名:
+        metrics.observe(指标名, 历史.token数)
+        if 历史.截断条数:
+            metrics.incr(f"{指标名}截断", 历史.截断条数)
+    return 历史.文本
+
+
+async def 补全图片描述(占位列表: list):
+    """
+    后台并发识别一条消息中的全部图片，每张识别完成后立即写回对应的占位，不阻塞任何消息。
+
+    单条消息内的并发数受 每条消息图片并发 限制，全局再受 图片识别并发 限制，
+    整条消息共用一个截止时间，超时未完成的图片保留[图片]占位。
+    """
+    本条并发 = asyncio.Semaphore(每条消息图片并发)
+
+    async def 识别一张(占位: 图片占位):
+        try:
+            async with 本条并发, 图片识别并发:
+                占位.描述 = await 图片识别(占位.链接, 图片模型_key, 图片模型_url, 图片模型_model, 文件名=占位.文件名 or None)
+            # 日志输出在图片识别函数内部
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error(f"图片识别出错: {e}")
+        finally:
+            占位.pending = False
+
+    try:
+        async with asyncio.timeout(图片识别超时):
+            await asyncio.gather(*(识别一张(占位) for 占位 in 占位列表))
+    except TimeoutError:
+        warning("图片识别长时间不返回内容，保留[图片]占位")
+
+
+def 加入上下文(群号: int, 条目: ContextEntry):
+    """添加一条记录到群聊上下文，超出配置长度的旧记录由环形缓冲区自动丢弃。"""
+    群聊上下文.append(群号, 条目)
+
+
+async def 丰富消息(event: GroupEvent):
+    """流水线第一阶段：替换@并按原顺序把文字和图片写入群聊上下文，图片交给后台识别。"""
+    群号, 人名 = event.group_id, event.sender_name
+    片段 = []
+    文字下标 = []
+    待识别 = []
+    for 类型, 内容, 文件名 in event.segments:
+        if 类型 == "文字":
+            文字下标.append(len(片段))
+            片段.append(内容)
+        elif 类型 == "图片":
+            占位 = 图片占位(内容, 文件名)
+            片段.append(占位)
+            # 降级处理时不识别图片，上下文中保留[图片]占位
+            if 图片模型_switch and 内容 and not event.degraded:
+                占位.pending = True
+                待识别.append(占位)
+        else:
+            片段.append(f"[{类型}]")
+
+    # 只要文字中包含 @后跟5~12位数字，就执行一次替换（可能有多个@数字会统一处理）
+    # 处理 @QQ -> @昵称 并判断是否被@
+    async def 替换at(文字: str) -> str:
+        try:
+            if re.search(r"@\d{5,12}", 文字):
+                return await 替换消息中的at(文字, host, port, bot_qq=bot_qq, bot_name=bot_name, 群号=群号, websocket=当前连接)
+        except Exception as e:
+            warning(f"处理@用户名时出错: {e}")
+        return 文字
+    for i, 文字 in zip(文字下标, await asyncio.gather(*(替换at(片段[i]) for i in 文字下标))):
+        片段[i] = 文字
+
+    # 为每个群聊维护独立的上下文记录（格式："用户名: 消息内容"），图片识别完成后原地补上描述
+    event.context_entry = ContextEntry(人名, 片段, kind=event.msg_type)
+    加入上下文(群号, event.context_entry)
+    if 待识别:
+        流水线.spawn(补全图片描述(待识别))
+    event.content = "".join(str(p) for p in 片段).strip()
+    if 复读开关 and event.msg_type == "文字":
+        event.repeat_count = 复读追踪.observe(群号, event.sender_id, event.content)
+    return event
+
+
+def _上下文指纹(event: GroupEvent) -> int:
+    return 上下文指纹((条目.text for 条目 in 群聊上下文.last(event.group_id, 8)), event.content)
+
+
+def 复读判定(event: GroupEvent):
+    """
+    复读链中的消息不再判断：到达跟读阈值时机器人跟读一次，其余直接跳过；
+    近期判断过的相同消息（上下文相近）复用之前的兴趣度。返回 None 表示需要正常判断。
+    """
+    if event.repeat_count >= 2:
+        if (跟读阈值 and event.repeat_count >= 跟读阈值 and 适合跟读(event.content)
+                and not 含敏感词(event.content, event.sender_name) and 复读追踪.try_join(event.group_id)):
+            跟读内容 = 替换回复(event.content, 替换词, 被替换词)
+            info(f"群{event.group_id}正在复读「{event.content}」，跟读一次")
+            outbound_queue.enqueue(event.group_id, 跟读内容)
+            加入上下文(event.group_id, ContextEntry(bot_name, [跟读内容], kind="bot"))
+            metrics.incr("复读跟读")
+        else:
+            metrics.incr("复读跳过")
+        return False
+    兴趣 = 判断缓存.get(event.group_id, event.content, _上下文指纹(event))
+    if 兴趣 is None:
+        return None
+    metrics.incr("判断缓存命中")
+    info(f"收到来自{event.group_id}的{event.sender_name}消息: {event.content}。兴趣度:{兴趣}(缓存)")
+    event.interest = 兴趣
+    return 兴趣 >= reply_interest
+
+
+def _检查兴趣(兴趣):
+    if 兴趣 == "error:0":
+        warning("判断错误0:判断模型返回值为空")
+        return 0
+    if 兴趣 == "error:1":
+        warning("判断错误1:ValueError")
+        return 0
+    return 兴趣
+
+
+async def 判断兴趣(events: list) -> list:
+    """
+    流水线第二阶段：只对文字消息判断兴趣，返回每条消息是否需要回复。
+
+    被@的消息和本地模型有把握的消息直接得出结果，其余消息只有一条时单独调用判断模型，
+    有多条时合并成一次批量判断请求。
+    """
+    结果 = [False] * len(events)
+    待判断 = []
+    样本上下文 = {}  # 与本地模型打分时相同的消息记录，用来记录训练样本
+    for i, event in enumerate(events):
+        if event.msg_type != "文字":
+            continue
+        消息内容, 群号 = event.content, event.group_id
+        # 与 llm_if 的被@快速通道条件一致，回复时走调度器的优先通道
+        event.priority = event.priority or ("@" in 消息内容 and str(bot_name) in 消息内容)
+        if 复读开关 and not event.priority:
+            判定 = 复读判定(event)
+            if 判定 is not None:
+                结果[i] = 判定
+                continue
+        if event.degraded and not event.priority:
+            # 积压时闲聊只用本地模型判断，没有把握就不回复
+            本地分数 = interest_model.本地打分(上下文文本(群号, 5, 判断token预算, 截至=event.context_entry), 消息内容, reply_interest)
+            event.interest = 本地分数 or 0
+            结果[i] = 本地分数 is not None and 本地分数 >= reply_interest
+            metrics.incr("降级跳过判断")
+            continue
+        if len(events) == 1 or event.priority:
+            结果[i] = await 判断单条兴趣(event)
+            continue
+        # 同一批的消息都已写入上下文，只取到本条为止，与单条判断和训练样本一致
+        最近五条 = 上下文文本(群号, 5, 判断token预算, 截至=event.context_entry)
+        本地结果 = _本地判断(event, 最近五条)
+        if 本地结果 is not None:
+            结果[i] = 本地结果
+            continue
+        待判断.append(i)
+        样本上下文[i] = 最近五条
+    if len(待判断) == 1:
+        结果[待判断[0]] = await 判断单条兴趣(events[待判断[0]])
+    elif 待判断:
+        群号 = events[0].group_id
+        # 批量消息本身都已在上下文末尾，消息记录多取这么多条
+        消息记录 = 上下文文本(群号, 5 + len(待判断), 判断token预算, "判断上下文token")
+        消息列表 = [(f"{events[i].sender_name}发了消息:{events[i].content}", events[i].content) for i in 待判断]
+        try:
+            分数列表 = await llm_if_batch(消息列表, bot_name, 判断模型_url, 判断模型_key, 判断模型_model, 提示词, 消息记录=消息记录)
         except Exception as e:
-            error(f"出现错误: {e}")
-            await asyncio.sleep(5)  # 等待5秒后重新连接
-        
+            warning(f"判断模型出错: {e}")
+            分数列表 = [0] * len(待判断)
+        metrics.incr("批量判断")
+        metrics.observe("批量判断条数", len(待判断))
+        for i, 兴趣 in zip(待判断, 分数列表):
+            event = events[i]
+            if 兴趣 not in ("error:0", "error:1"):
+                interest_model.记录样本(样本上下文[i], event.content, 兴趣)
+                判断缓存.put(event.group_id, event.content, _上下文指纹(event), 兴趣)
+            兴趣 = _检查兴趣(兴趣)
+            info(f"收到来自{event.group_id}的{event.sender_name}消息: {event.content}。兴趣度:{兴趣}")
+            event.interest = 兴趣
+            结果[i] = 兴趣 >= reply_interest
+    return 结果
+
+
+def _本地判断(event: GroupEvent, 最近五条: str) -> Optional[bool]:
+    """本地模型的分数离回复阈值足够远时直接采用，不再调用判断模型；没有把握时返回 None。"""
+    本地分数 = interest_model.本地打分(最近五条, event.content, reply_interest)
+    if 本地分数 is None:
+        return None
+    metrics.incr("本地判断")
+    info(f"收到来自{event.group_id}的{event.sender_name}消息: {event.content}。本地兴趣度:{本地分数:.1f}")
+    event.interest = 本地分数
+    return 本地分数 >= reply_interest
+
+
+async def 判断单条兴趣(event: GroupEvent) -> bool:
+    """对一条文字消息判断兴趣，优先使用本地模型，返回是否需要回复。"""
+    消息内容, 群号, 人名 = event.content, event.group_id, event.sender_name
+    最近五条 = 上下文文本(群号, 5, 判断token预算, "判断上下文token", 截至=event.context_entry)
+    兴趣 = 0
+    本地结果 = None if event.priority else _本地判断(event, 最近五条)
+    if 本地结果 is not None:
+        return 本地结果
+    推测 = None if event.priority else 开始推测回复(event)
+    判断开始 = time.monotonic()
+    try:
+        兴趣 = await llm_if((f"""{人名}发了消息:{消息内容}"""), bot_name, bot_qq, 判断模型_url, 判断模型_key, 判断模型_model, 消息内容, 提示词, 消息记录=最近五条)
+        if 兴趣 in ("error:0", "error:1"):
+            兴趣 = _检查兴趣(兴趣)
+        elif not event.priority:
+            interest_model.记录样本(最近五条, 消息内容, 兴趣)
+            判断缓存.put(群号, 消息内容, _上下文指纹(event), 兴趣)
+        metrics.incr("模型判断")
+    except Exception as e:
+        warning(f"判断模型出错: {e}")
+    info(f"收到来自{群号}的{人名}消息: {消息内容}。兴趣度:{兴趣}")
+    if 推测 is not None:
+        结束推测(event, 推测, 兴趣>=reply_interest, time.monotonic() - 判断开始)
+    event.interest = 兴趣
+    return 兴趣>=reply_interest
+
+
+_疑问 = re.compile(r"[?？]|[吗嘛呢么]\s*$")
+
+
+def 推测信号(event: GroupEvent) -> bool:
+    """提到机器人名字或像是提问的消息大概率需要回复。"""
+    return str(bot_name) in event.content or bool(_疑问.search(event.content))
+
+
+def 开始推测回复(event: GroupEvent):
+    """对大概率需要回复的消息，在判断的同时开始生成回复。推测名额用完时不推测。"""
+    if not 推测开关 or 推测并发.locked() or not 推测信号(event):
+        return None
+    群消息历史 = 上下文文本(event.group_id, 0, 回复token预算)
+    # 估算的 token 数记在事件上，推测结果没用上时按它计入浪费
+    event.speculative_tokens = 计算token数(群消息历史)
+
+    async def 推测生成():
+        async with 推测并发:
+            开始 = time.monotonic()
+            回复内容 = await 生成回复(event, 群消息历史)
+            event.speculative_tokens += 计算token数(回复内容 or "")
+            return 回复内容, time.monotonic() - 开始
+
+    metrics.incr("推测开始")
+    return 流水线.spawn(推测生成())
+
+
+def 结束推测(event: GroupEvent, 任务: asyncio.Task, 需要回复: bool, 判断耗时: float):
+    """判断通过时把推测任务交给回复阶段，否则取消并按估算计入浪费的 token。"""
+    if 需要回复:
+        # 命中与节省的时间在回复真正用上推测结果时再记录，没用上的由流水线计入浪费
+        event.speculative_reply = 任务
+        event.judge_seconds = 判断耗时
+        return
+    metrics.incr("推测浪费")
+    任务.cancel()
+    metrics.observe("推测浪费token", event.speculative_tokens)
+
+
+async def 生成回复(event: GroupEvent, 群消息历史: str) -> str:
+    """调用回复模型生成回复，不发送。"""
+    消息内容, 群号, 人名 = event.content, event.group_id, event.sender_name
+    单条完整消息=f"{人名}发了: {消息内容}"
+    debug(f"发给回复模型的消息历史:{群消息历史}")
+    return await llm_send_message(消息历史=群消息历史,单条完整消息=单条完整消息,那个人的名字=人名,bot名字=bot_name,提示词=提示词,群号=群号,napcat_host=host,napcat_port=port,api_url=回复模型_url,api_key=回复模型_key,模型=回复模型_model,是否发至群里=False,最大token=maxtoken,替换词=替换词, 被替换词=被替换词, websocket=当前连接, 流式=流式回复, 最大字数=回复最大字数)
+
+
+async def 回复群消息(event: GroupEvent):
+    """流水线第三阶段：取得回复（推测生成的或现在生成），发送并写回群聊上下文。"""
+    群号 = event.group_id
+    生成耗时 = None
+    try:
+        if event.speculative_reply is not None:
+            回复内容, 生成耗时 = await event.speculative_reply
+        else:
+            # 使用该群的完整消息历史作为上下文
+            群消息历史 = 上下文文本(群号, 0, 回复token预算, "回复上下文token")
+            回复内容 = await 生成回复(event, 群消息历史)
+        if 回复内容 == "111111111":
+            info(f"群{群号}的回复触发了敏感词检查或为空，不发送")
+            return
+        if 回复内容 == "0":
+            info(f"回复模型认为群{群号}的这条消息不需要回复")
+            return
+        if 流水线.is_stale(event):
+            info(f"群{群号}的对话已经继续，丢弃过时的回复: {回复内容}")
+            metrics.incr("回复过时丢弃")
+            return
+        if 生成耗时 is not None:
+            event.speculative_reply = None  # 推测结果已用上，不再计入浪费
+            metrics.incr("推测命中")
+            metrics.observe("推测节省秒数", round(min(event.judge_seconds, 生成耗时), 3))
+        outbound_queue.enqueue(群号, 回复内容)
+        # 将bot的回复也添加到群聊上下文中
+        if 回复内容:
+            加入上下文(群号, ContextEntry(bot_name, [回复内容], kind="bot"))
+    except Exception as e:
+        error(f"回复模型出错: {e}")
+
+
 # 示例使用
 if __name__ == "__main__":
     # 这里可以调用你的函数
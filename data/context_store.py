@@ -0,0 +1,188 @@
+import asyncio
+import itertools
+import json
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from log import info, warning
+
+# 追加写入的上下文日志，每行一条 JSON 记录，重启时按行回放
+JOURNAL_FILENAME = "group_context.jsonl"
+
+
+class ContextEntry:
+    """
+    群聊上下文中的一条记录: (发送者, 内容, 时间戳, 类型)。
+
+    内容由文字和图片占位等片段按原顺序组成，打印时实时拼接，
+    因此后台补上的图片描述会自动出现在之后的上下文里。
+    片段的 pending 属性为真时表示内容还会变化，写回日志会等到它结束。
+    类型为消息类型（"文字"、"图片"……），机器人自己的回复为 "bot"。
+    """
+
+    __slots__ = ("sender", "parts", "timestamp", "kind")
+
+    def __init__(self, sender: str, parts: list, timestamp: Optional[float] = None, kind: str = "文字"):
+        self.sender = sender
+        self.parts = parts
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.kind = kind
+
+    @property
+    def text(self) -> str:
+        return "".join(str(p) for p in self.parts)
+
+    @property
+    def pending(self) -> bool:
+        return any(getattr(p, "pending", False) for p in self.parts)
+
+    def __str__(self):
+        return f"{self.sender}: {self.text}"
+
+
+class ContextStore:
+    """
+    按群保存最近若干条上下文的环形缓冲区，可选持久化到 data/group_context.jsonl。
+
+    每个群一个定长 deque，追加是 O(1)，超出容量的旧记录自动丢弃；
+    last(k) 只遍历最后 k 条。新记录在写回间隔后批量追加到日志文件，
+    日志过长时整体重写为当前内容，启动时回放日志恢复上下文。
+    """
+
+    def __init__(self, capacity: int = 15, path: Optional[str] = None,
+                 persist: bool = True, flush_interval: float = 10.0):
+        self._capacity = max(1, int(capacity))
+        self._path = path or os.path.join(os.path.dirname(__file__), JOURNAL_FILENAME)
+        self._persist = persist
+        self._flush_interval = float(flush_interval)
+        self._groups: Dict[int, Deque[ContextEntry]] = {}
+        self._unsaved: List[tuple] = []
+        self._journal_lines = 0
+        self._flush_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def _buffer(self, 群号: int) -> Deque[ContextEntry]:
+        buffer = self._groups.get(群号)
+        if buffer is None:
+            buffer = deque(maxlen=self._capacity)
+            self._groups[群号] = buffer
+        return buffer
+
+    def append(self, 群号: int, entry: ContextEntry) -> None:
+        self._buffer(群号).append(entry)
+        if self._persist:
+            self._unsaved.append((群号, entry))
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    def last(self, 群号: int, k: int = 0, until: Optional[ContextEntry] = None) -> List[ContextEntry]:
+        """
+        返回该群最近 k 条记录（按时间顺序），k 为 0 时返回全部。
+
+        指定 until 时只取到这条记录为止（包括它），它已被挤出缓冲区时按最新的记录取。
+        """
+        buffer = self._groups.get(群号)
+        if not buffer:
+            return []
+        if until is not None and buffer[-1] is not until:
+            entries = []
+            for entry in reversed(buffer):
+                if entries or entry is until:
+                    entries.append(entry)
+                    if k and len(entries) >= k:
+                        break
+            if entries:
+                entries.reverse()
+                return entries
+        if not k or k >= len(buffer):
+            return list(buffer)
+        entries = list(itertools.islice(reversed(buffer), k))
+        entries.reverse()
+        return entries
+
+    def text(self, 群号: int, k: int = 0) -> str:
+        """把最近 k 条记录拼成文本，每条一行。"""
+        return "\n".join(str(entry) for entry in self.last(群号, k))
+
+    def load(self) -> None:
+        """启动时回放日志文件，只保留每个群最近 capacity 条。"""
+        if not self._persist or not os.path.exists(self._path):
+            return
+        lines = 0
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        record = json.loads(line)
+                        entry = ContextEntry(record["s"], [record["t"]], record["ts"], record.get("k", "文字"))
+                        self._buffer(int(record["g"])).append(entry)
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except OSError as e:
+            warning(f"读取群聊上下文 {self._path} 失败: {e}")
+            return
+        self._journal_lines = lines
+        info(f"已恢复{len(self._groups)}个群的聊天上下文")
+
+    @staticmethod
+    def _record(群号: int, entry: ContextEntry) -> str:
+        return json.dumps({"g": 群号, "s": entry.sender, "t": entry.text, "ts": entry.timestamp, "k": entry.kind},
+                          ensure_ascii=False) + "\n"
+
+    def _write(self, lines: List[str], rewrite: bool) -> None:
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        if rewrite:
+            tmp = self._path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.writelines(lines)
+            os.replace(tmp, self._path)
+        else:
+            with open(self._path, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+
+    async def _delayed_flush(self) -> None:
+        # 还有图片没识别完的记录留到下一轮再写
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await self.flush()
+            if not self._unsaved:
+                return
+
+    async def flush(self, force: bool = False) -> None:
+        """
+        把新记录追加到日志；日志行数超过当前内容的两倍时整体重写。
+
+        从第一条内容还会变化的记录起（包括之后的记录，保持顺序）留到下次写回，force 为真时全部写入。
+        """
+        async with self._lock:
+            if not self._unsaved:
+                return
+            held = 0 if force else next((i for i, (_, entry) in enumerate(self._unsaved) if entry.pending),
+                                        len(self._unsaved))
+            pending, self._unsaved = self._unsaved[:held], self._unsaved[held:]
+            if not pending:
+                return
+            live = sum(len(buffer) for buffer in self._groups.values())
+            # 有记录留待写回时不重写，否则之后追加时会重复
+            rewrite = not self._unsaved and self._journal_lines + len(pending) > 2 * live + self._capacity
+            if rewrite:
+                lines = [self._record(群号, entry) for 群号, buffer in self._groups.items() for entry in buffer]
+            else:
+                lines = [self._record(群号, entry) for 群号, entry in pending]
+            try:
+                await asyncio.to_thread(self._write, lines, rewrite)
+            except Exception as e:
+                self._unsaved = pending + self._unsaved
+                warning(f"写入群聊上下文 {self._path} 失败: {e}")
+                return
+            self._journal_lines = len(lines) if rewrite else self._journal_lines + len(lines)
+
+    async def close(self) -> None:
+        """写回剩余记录。先等锁内正在进行的写回完成，再取消还在等待的延迟写回。"""
+        await self.flush(force=True)
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
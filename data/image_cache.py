@@ -0,0 +1,224 @@
+import os
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from log import info, warning
+from data.image_hash import BKTree
+
+# 索引化的持久缓存（SQLite，WAL 模式保证崩溃安全），旧的 JSON 缓存会在首次打开时迁移进来
+DB_FILENAME = "Image_description_cache.db"
+LEGACY_JSON_FILENAME = "Image_description_cache.txt"
+
+
+def _data_path(filename: str) -> str:
+    return os.path.join(os.path.dirname(__file__), filename)
+
+
+class ImageDescriptionCache:
+    """
+    图片描述的两级缓存：内存 LRU + SQLite 持久层。
+
+    查询先走内存 LRU，未命中再按主键查 SQLite，两者都是 O(1)。
+    持久层按条数上限和最后命中时间淘汰，内存命中的时间戳会批量写回。
+    带感知哈希的条目同时放入 BK 树，用于查找被重新压缩过的相似图片。
+    """
+
+    def __init__(self, db_path: Optional[str] = None, memory_size: int = 512,
+                 max_entries: int = 20000, max_age_days: float = 90, similar_threshold: int = 6):
+        self._db_path = db_path or _data_path(DB_FILENAME)
+        self._memory_size = max(1, int(memory_size))
+        self._max_entries = int(max_entries)
+        self._max_age = float(max_age_days) * 86400
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._aliases: "OrderedDict[str, str]" = OrderedDict()
+        self._touched: Dict[str, float] = {}
+        self._writes_since_evict = 0
+        self._similar_threshold = int(similar_threshold)
+        self._phash_tree = BKTree()
+        self._conn = sqlite3.connect(self._db_path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS descriptions ("
+            "hash TEXT PRIMARY KEY, description TEXT NOT NULL, "
+            "created_at REAL NOT NULL, last_hit REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_descriptions_last_hit ON descriptions(last_hit)")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(descriptions)")]
+        if "phash" not in columns:
+            self._conn.execute("ALTER TABLE descriptions ADD COLUMN phash TEXT")
+        # 图片标识（QQ 的 fileid、文件名等）到内容哈希的映射，用于下载前查询
+        self._conn.execute("CREATE TABLE IF NOT EXISTS aliases (alias TEXT PRIMARY KEY, hash TEXT NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+        self._migrate_legacy_json()
+        self.evict()
+        for key, phash in self._conn.execute("SELECT hash, phash FROM descriptions WHERE phash IS NOT NULL"):
+            self._phash_tree.add(int(phash, 16), key)
+
+    def _migrate_legacy_json(self):
+        """把旧版 JSON 缓存文件一次性导入 SQLite。"""
+        done = self._conn.execute("SELECT value FROM meta WHERE key='legacy_json_migrated'").fetchone()
+        if done:
+            return
+        legacy = _data_path(LEGACY_JSON_FILENAME)
+        entries = {}
+        if os.path.exists(legacy) and os.path.getsize(legacy) > 0:
+            try:
+                with open(legacy, 'r', encoding='utf-8') as f:
+                    entries = json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                warning(f"读取旧图片缓存 {legacy} 失败，跳过迁移: {e}")
+                entries = {}
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO descriptions (hash, description, created_at, last_hit) VALUES (?, ?, ?, ?)",
+                [(k, v, now, now) for k, v in entries.items() if isinstance(v, str)],
+            )
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_json_migrated', ?)", (str(now),))
+        if entries:
+            info(f"已将 {len(entries)} 条旧图片描述缓存迁移到 {self._db_path}")
+
+    def _remember(self, key: str, description: str):
+        self._memory[key] = description
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._memory_size:
+            self._memory.popitem(last=False)
+
+    def _remember_alias(self, alias: str, key: str):
+        self._aliases[alias] = key
+        self._aliases.move_to_end(alias)
+        while len(self._aliases) > self._memory_size:
+            self._aliases.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        description = self._memory.get(key)
+        if description is not None:
+            self._memory.move_to_end(key)
+            self._touched[key] = time.time()
+            return description
+        row = self._conn.execute("SELECT description FROM descriptions WHERE hash=?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._touched[key] = time.time()
+        self._remember(key, row[0])
+        return row[0]
+
+    def get_by_alias(self, alias: str) -> Optional[str]:
+        """按图片标识查询描述，不需要先下载图片。"""
+        key = self._aliases.get(alias)
+        if key is None:
+            row = self._conn.execute("SELECT hash FROM aliases WHERE alias=?", (alias,)).fetchone()
+            if row is None:
+                return None
+            key = row[0]
+        self._remember_alias(alias, key)
+        return self.get(key)
+
+    def put_alias(self, alias: str, key: str):
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO aliases (alias, hash) VALUES (?, ?)", (alias, key))
+        self._remember_alias(alias, key)
+
+    def find_similar(self, phash: int) -> Optional[str]:
+        """按感知哈希查找汉明距离在阈值内的已缓存描述，阈值为 0 时不启用。"""
+        if self._similar_threshold <= 0:
+            return None
+        for distance, key in self._phash_tree.search(phash, self._similar_threshold):
+            # 描述不在内存中时才查询数据库
+            description = self.get(key)
+            if description is not None:
+                return description
+        return None
+
+    def put(self, key: str, description: str, phash: Optional[int] = None):
+        if not description:
+            return  # 描述列不允许为空，没有描述的图片不缓存
+        now = time.time()
+        phash_hex = f"{phash:016x}" if phash is not None else None
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO descriptions (hash, description, created_at, last_hit, phash) VALUES (?, ?, ?, ?, ?)",
+                (key, description, now, now, phash_hex),
+            )
+        if phash is not None:
+            self._phash_tree.add(phash, key)
+        else:
+            self._phash_tree.remove(key)
+        self._remember(key, description)
+        self._writes_since_evict += 1
+        if self._writes_since_evict >= 100:
+            self.evict()
+
+    def _flush_touched(self):
+        if not self._touched:
+            return
+        touched, self._touched = self._touched, {}
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE descriptions SET last_hit=? WHERE hash=?",
+                [(ts, key) for key, ts in touched.items()],
+            )
+
+    def evict(self):
+        """写回命中时间，并按保留天数和条数上限淘汰最久未命中的条目。"""
+        self._writes_since_evict = 0
+        self._flush_touched()
+        evicted = []
+        with self._conn:
+            if self._max_age > 0:
+                cutoff = time.time() - self._max_age
+                evicted += self._conn.execute("SELECT hash FROM descriptions WHERE last_hit < ?", (cutoff,)).fetchall()
+                self._conn.execute("DELETE FROM descriptions WHERE last_hit < ?", (cutoff,))
+            if self._max_entries > 0:
+                overflow = self._conn.execute(
+                    "SELECT hash FROM descriptions ORDER BY last_hit DESC LIMIT -1 OFFSET ?", (self._max_entries,)
+                ).fetchall()
+                self._conn.executemany("DELETE FROM descriptions WHERE hash=?", overflow)
+                evicted += overflow
+            self._conn.execute("DELETE FROM aliases WHERE hash NOT IN (SELECT hash FROM descriptions)")
+        # 被淘汰的条目同时移出相似查找树，避免查询命中后再去数据库确认
+        for (key,) in evicted:
+            self._phash_tree.remove(key)
+
+    def close(self):
+        try:
+            self._flush_touched()
+        finally:
+            self._conn.close()
+
+
+_cache: Optional[ImageDescriptionCache] = None
+
+
+def configure(picture_config: dict) -> ImageDescriptionCache:
+    """根据 [model.picture] 段创建全局图片描述缓存。"""
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = ImageDescriptionCache(
+        memory_size=picture_config.get('缓存内存条数', 512),
+        max_entries=picture_config.get('缓存最大条数', 20000),
+        max_age_days=picture_config.get('缓存保留天数', 90),
+        similar_threshold=picture_config.get('相似图片阈值', 6),
+    )
+    return _cache
+
+
+def get_cache() -> ImageDescriptionCache:
+    """获取全局图片描述缓存，未配置时使用默认参数创建。"""
+    global _cache
+    if _cache is None:
+        _cache = ImageDescriptionCache()
+    return _cache
+
+
+def close() -> None:
+    global _cache
+    if _cache is not None:
+        _cache.close()
+        _cache = None
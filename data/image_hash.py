@@ -0,0 +1,125 @@
+import io
+from typing import Dict, List, Optional, Tuple
+
+from log import warning
+
+try:
+    from PIL import Image
+except ImportError:  # 感知哈希是可选功能，未安装 pillow 时退化为只按 MD5 精确匹配
+    Image = None
+
+_warned_missing = False
+
+
+def 感知哈希(image_content: bytes) -> Optional[int]:
+    """
+    计算图片的 64 位差值哈希(dHash)。
+
+    QQ 会反复压缩、缩放同一张表情包，MD5 因此对不上，但 dHash 基本不变，
+    可用汉明距离判断两张图是否相同。动图取第一帧。解码失败或未安装 pillow 时返回 None。
+    该函数是 CPU 密集操作，应通过 asyncio.to_thread 调用。
+    """
+    global _warned_missing
+    if Image is None:
+        if not _warned_missing:
+            warning("未安装 pillow，相似图片匹配已停用（pip install pillow 后启用）")
+            _warned_missing = True
+        return None
+    try:
+        with Image.open(io.BytesIO(image_content)) as img:
+            img.seek(0)
+            pixels = list(img.convert("L").resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    except Exception:
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def 汉明距离(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """按汉明距离组织的 BK 树，查询距离阈值内的近似哈希只需访问很少的节点。每个键只对应一个哈希值。"""
+
+    def __init__(self):
+        # 节点结构: [哈希值, 该哈希对应的键列表, {距离: 子节点}]
+        self._root: Optional[list] = None
+        self._values: Dict[str, int] = {}
+        self._nodes = 0
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._values
+
+    def add(self, value: int, key: str):
+        old = self._values.get(key)
+        if old == value:
+            return
+        if old is not None:
+            self.remove(key)
+        self._values[key] = value
+        if self._root is None:
+            self._root = [value, [key], {}]
+            self._nodes += 1
+            return
+        node = self._root
+        while True:
+            d = 汉明距离(value, node[0])
+            if d == 0:
+                node[1].append(key)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [key], {}]
+                self._nodes += 1
+                return
+            node = child
+
+    def remove(self, key: str):
+        """移除一个键。节点本身留作路由，空节点过多时整体重建。"""
+        value = self._values.pop(key, None)
+        if value is None:
+            return
+        node = self._root
+        while node is not None:
+            d = 汉明距离(value, node[0])
+            if d == 0:
+                node[1].remove(key)
+                break
+            node = node[2].get(d)
+        if self._nodes > 2 * len(self._values) + 64:
+            self._rebuild()
+
+    def _rebuild(self):
+        values, self._values = self._values, {}
+        self._root = None
+        self._nodes = 0
+        for key, value in values.items():
+            self.add(value, key)
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, str]]:
+        """返回距离不超过 max_distance 的 (距离, 键)，按距离从近到远排序。"""
+        if self._root is None:
+            return []
+        found: List[Tuple[int, str]] = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            d = 汉明距离(value, node[0])
+            if d <= max_distance:
+                found.extend((d, k) for k in node[1])
+            children: Dict[int, list] = node[2]
+            for dist in range(max(1, d - max_distance), d + max_distance + 1):
+                child = children.get(dist)
+                if child is not None:
+                    stack.append(child)
+        found.sort()
+        return found
@@ -1,26 +1,54 @@
 import os
 import re
+import time
 import asyncio
-from typing import Dict, Optional, Union, Any
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Union, Any
 
 import json
 import websockets
 
 from log import info, warning
+from onebot import action_client
 
 # 存储映射的文件名（和本文件在同一目录）
 MAPPING_FILENAME = "Group_members_name.txt"
 _LOCK = asyncio.Lock()
 
+# 内存中的昵称缓存: 群号 -> OrderedDict(QQ号 -> (昵称, 过期时间))，群号 0 存放不区分群的昵称
+# 文件只在启动时读取一次，之后的新增由后台任务定期整体写回（write-behind）
+_缓存: Dict[int, "OrderedDict[str, Tuple[str, float]]"] = {}
+_已加载 = False
+_有未保存修改 = False
+_写回任务: Optional[asyncio.Task] = None
+# 正在查询的 (群号, QQ号)，同一个人同时只查询一次
+_查询中: Dict[Tuple[int, str], asyncio.Task] = {}
+
+_ttl = 6 * 3600.0
+_每群上限 = 2000
+_写回间隔 = 30.0
+
+
+def configure(nickname_config: dict) -> None:
+    """根据 bot_config.toml 的 [nickname] 段设置缓存参数。"""
+    global _ttl, _每群上限, _写回间隔
+    _ttl = float(nickname_config.get('有效期秒数', _ttl))
+    _每群上限 = int(nickname_config.get('每群上限', _每群上限))
+    _写回间隔 = float(nickname_config.get('写回间隔秒数', _写回间隔))
+
 
 def _mapping_path() -> str:
     return os.path.join(os.path.dirname(__file__), MAPPING_FILENAME)
 
 
-def _load_mapping(file_path: Optional[str] = None) -> Dict[str, str]:
-    """读取 QQ 号到用户名的映射表，支持冒号格式，忽略无效行。"""
+def _load_mapping(file_path: Optional[str] = None) -> Dict[Tuple[int, str], str]:
+    """
+    读取昵称映射表，支持冒号格式，忽略无效行。
+
+    每行为 "QQ号@群号 : 昵称"（群名片）或旧格式 "QQ号 : 昵称"（不区分群，群号记为 0）。
+    """
     path = file_path or _mapping_path()
-    mapping: Dict[str, str] = {}
+    mapping: Dict[Tuple[int, str], str] = {}
     if not os.path.exists(path):
         return mapping
     try:
@@ -33,80 +61,207 @@ def _load_mapping(file_path: Optional[str] = None) -> Dict[str, str]:
                 if sep not in line:
                     continue
                 left, right = [part.strip() for part in line.split(sep, 1)]
-                m = re.search(r"\d+", left)
+                m = re.search(r"(\d+)(?:\s*@\s*(\d+))?", left)
                 if m and right:
-                    mapping[m.group(0)] = right
+                    mapping[(int(m.group(2) or 0), m.group(1))] = right
     except Exception as e:
         warning(f"读取 {path} 失败: {e}")
     return mapping
 
 
-async def _append_mapping(qq号: str, 昵称: str, file_path: Optional[str] = None) -> None:
-    """追加映射，若超过100条，删除最旧条目。"""
+def _ensure_loaded() -> None:
+    global _已加载
+    if _已加载:
+        return
+    _已加载 = True
+    过期时间 = time.time() + _ttl
+    for (群, qq), 昵称 in _load_mapping().items():
+        _缓存.setdefault(群, OrderedDict())[qq] = (昵称, 过期时间)
+
+
+def _cache_get(群: int, qq: str, 允许过期: bool = False) -> Optional[str]:
+    entry = _缓存.get(群, {}).get(qq)
+    if entry is None:
+        return None
+    昵称, 过期时间 = entry
+    if not 允许过期 and 过期时间 < time.time():
+        return None
+    _缓存[群].move_to_end(qq)
+    return 昵称
+
+
+def _cache_put(群: int, qq: str, 昵称: str, 记录日志: bool = True) -> None:
+    """写入内存缓存并安排写回文件，每个群超过上限时淘汰最久未使用的条目。"""
+    global _有未保存修改
+    group_cache = _缓存.setdefault(群, OrderedDict())
+    旧值 = group_cache.get(qq)
+    group_cache[qq] = (昵称, time.time() + _ttl)
+    group_cache.move_to_end(qq)
+    while len(group_cache) > _每群上限:
+        group_cache.popitem(last=False)
+    if 旧值 is None or 旧值[0] != 昵称:
+        _有未保存修改 = True
+        _schedule_flush()
+        if 记录日志:
+            info(f"已记录用户 {qq} -> {昵称}")
+
+
+def _schedule_flush() -> None:
+    global _写回任务
+    if _写回任务 is None or _写回任务.done():
+        _写回任务 = asyncio.create_task(_delayed_flush())
+
+
+async def _delayed_flush() -> None:
+    await asyncio.sleep(_写回间隔)
+    await flush()
+
+
+def _write_mapping(path: str, lines: list) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+    os.replace(tmp, path)
+
+
+async def flush(file_path: Optional[str] = None) -> None:
+    """把内存中的昵称整体写回文件（先写临时文件再替换，避免写到一半时损坏）。"""
+    global _有未保存修改
     async with _LOCK:
+        if not _有未保存修改:
+            return
+        _有未保存修改 = False
         path = file_path or _mapping_path()
+        lines = []
+        for 群, group_cache in _缓存.items():
+            for qq, (昵称, _过期时间) in group_cache.items():
+                lines.append(f"{qq}@{群} : {昵称}\n" if 群 else f"{qq} : {昵称}\n")
         try:
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            mapping = _load_mapping(path)
-            if len(mapping) >= 100:
-                oldest_qq = next(iter(mapping))
-                with open(path, "r", encoding="utf-8") as f:
-                    lines = [line for line in f if not (line.strip().startswith(str(oldest_qq)) and (":" in line or "：" in line)) or line.strip().startswith("#")]
-                with open(path, "w", encoding="utf-8") as f:
-                    f.writelines(lines)
-            with open(path, "a", encoding="utf-8") as f:
-                f.write(f"{qq号} : {昵称}\n")
-            info(f"已记录用户 {qq号} -> {昵称}")
+            await asyncio.to_thread(_write_mapping, path, lines)
         except Exception as e:
+            _有未保存修改 = True
             warning(f"写入 {path} 失败: {e}")
 
 
-async def 获取或新增用户名(qq号: Union[int, str], napcat_host: str, napcat_port: int, 群号: Optional[int] = None, websocket=None) -> str:
-    """获取或查询并新增用户名，失败返回QQ号字符串。"""
-    qq_str = str(qq号)
-    映射 = _load_mapping()
-    if qq_str in 映射:
-        return 映射[qq_str]
+async def _query_and_store(qq_str: str, 群: int, napcat_host: str, napcat_port: int, websocket=None) -> Optional[str]:
     try:
-        昵称 = await 查询用户名_ws(int(qq_str), napcat_host, napcat_port, group_id=群号, websocket=websocket)
-        if 昵称:
-            await _append_mapping(qq_str, 昵称)
-            return 昵称
+        昵称 = await 查询用户名_ws(int(qq_str), napcat_host, napcat_port, group_id=群 or None, websocket=websocket)
     except Exception as e:
         warning(f"通过 WS 查询昵称失败[{qq_str}]: {e}")
-    return qq_str
+        return None
+    if 昵称:
+        _cache_put(群, qq_str, 昵称)
+    return 昵称
+
+
+async def 获取或新增用户名(qq号: Union[int, str], napcat_host: str, napcat_port: int, 群号: Optional[int] = None, websocket=None) -> str:
+    """获取或查询并新增用户名，失败时依次回退到过期的缓存和QQ号字符串。"""
+    _ensure_loaded()
+    qq_str = str(qq号)
+    群 = int(群号 or 0)
+    昵称 = _cache_get(群, qq_str) or _cache_get(0, qq_str)
+    if 昵称:
+        return 昵称
+    key = (群, qq_str)
+    task = _查询中.get(key)
+    if task is None:
+        task = asyncio.create_task(_query_and_store(qq_str, 群, napcat_host, napcat_port, websocket=websocket))
+        _查询中[key] = task
+        task.add_done_callback(lambda _t: _查询中.pop(key, None))
+    昵称 = await asyncio.shield(task)
+    if 昵称:
+        return 昵称
+    return _cache_get(群, qq_str, 允许过期=True) or _cache_get(0, qq_str, 允许过期=True) or qq_str
 
 
 async def 替换消息中的at(消息内容: str, napcat_host: str, napcat_port: int, *, bot_qq: Optional[int] = None, bot_name: Optional[str] = None, 群号: Optional[int] = None, websocket=None) -> str:
-    """替换消息中的@QQ为@昵称，支持机器人自身替换。"""
+    """替换消息中的@QQ为@昵称，支持机器人自身替换；同一条消息中的多个@并发查询。"""
     pattern = re.compile(r"@(\d{5,12})")
-    result_parts = []
-    last_idx = 0
+    qq_list = []
     for m in pattern.finditer(消息内容):
-        result_parts.append(消息内容[last_idx:m.start()])
         qq = m.group(1)
-        rep = m.group(0)
+        if qq not in qq_list and not (bot_qq and bot_name and int(qq) == bot_qq):
+            qq_list.append(qq)
+
+    async def _resolve(qq: str) -> str:
         try:
-            if bot_qq and bot_name and int(qq) == bot_qq:
-                rep = f"@{bot_name}"
-            else:
-                昵称 = await 获取或新增用户名(qq, napcat_host, napcat_port, 群号=群号, websocket=websocket)
-                if 昵称 != qq:
-                    rep = f"@{昵称}"
+            return await 获取或新增用户名(qq, napcat_host, napcat_port, 群号=群号, websocket=websocket)
         except Exception as e:
             warning(f"替换 @ 用户名失败[{qq}]: {e}")
-        result_parts.append(rep)
-        last_idx = m.end()
-    result_parts.append(消息内容[last_idx:])
-    return "".join(result_parts)
+            return qq
+    昵称表 = dict(zip(qq_list, await asyncio.gather(*(_resolve(qq) for qq in qq_list))))
+
+    def _replace(m: "re.Match") -> str:
+        qq = m.group(1)
+        if bot_qq and bot_name and int(qq) == bot_qq:
+            return f"@{bot_name}"
+        昵称 = 昵称表.get(qq, qq)
+        return f"@{昵称}" if 昵称 != qq else m.group(0)
+    return pattern.sub(_replace, 消息内容)
+
+
+async def 预热群成员昵称(群号列表: list, 并发: int = 2) -> None:
+    """
+    用 get_group_member_list 批量载入白名单群的全部成员昵称。
 
+    在连接建立时和定期刷新时调用，使 @ 替换基本不再需要逐个查询；
+    同时进行的群数受 并发 限制，避免启动时压垮 NapCat。
+    """
+    _ensure_loaded()
+    信号量 = asyncio.Semaphore(max(1, int(并发)))
 
-__all__ = ["获取或新增用户名", "替换消息中的at"]
+    async def _warm(群号: int) -> int:
+        async with 信号量:
+            try:
+                resp = await action_client.call("get_group_member_list", {"group_id": 群号}, timeout=30)
+            except Exception as e:
+                warning(f"获取群{群号}成员列表失败: {e!r}")
+                return 0
+        if not resp or resp.get("status") != "ok":
+            warning(f"获取群{群号}成员列表失败: {resp.get('wording') or resp.get('message') if resp else None}")
+            return 0
+        count = 0
+        for member in resp.get("data") or []:
+            qq = member.get("user_id")
+            昵称 = member.get("card") or member.get("nickname")
+            if qq and 昵称:
+                _cache_put(int(群号), str(qq), 昵称, 记录日志=False)
+                count += 1
+        return count
+
+    counts = await asyncio.gather(*(_warm(群号) for 群号 in 群号列表))
+    if 群号列表:
+        info(f"已预热 {len(群号列表)} 个群共 {sum(counts)} 个成员昵称")
+
+
+async def 定期预热群成员昵称(群号列表: list, 并发: int, 间隔: float) -> None:
+    """每隔 间隔 秒刷新一次全部白名单群的成员昵称，未连接时跳过本轮。"""
+    while True:
+        await asyncio.sleep(间隔)
+        if action_client.connected:
+            await 预热群成员昵称(群号列表, 并发)
+
+
+async def 刷新成员昵称(群号: int, qq号: Union[int, str], napcat_host: str, napcat_port: int) -> None:
+    """新成员入群时（group_increase 通知）立即查询并缓存其昵称。"""
+    _ensure_loaded()
+    await _query_and_store(str(qq号), int(群号), napcat_host, napcat_port)
+
+
+__all__ = ["获取或新增用户名", "替换消息中的at", "configure", "flush", "预热群成员昵称", "定期预热群成员昵称", "刷新成员昵称"]
 
 
 async def _onebot_ws_action(action: str, params: dict, napcat_host: str, napcat_port: int, echo: str, websocket=None) -> Optional[dict]:
     """执行OneBot WS动作并等待响应。"""
-    # 目前查询类操作依然新建连接，避免与主循环竞争读取
+    # 主连接可用时复用主连接，响应由主循环按 echo 分发回来
+    if action_client.connected:
+        try:
+            return await action_client.call(action, params)
+        except Exception as e:
+            warning(f"WS action {action} 失败: {e!r}")
+            return None
+    # 未运行主循环时（例如单独调用）才新建连接
     uri = f"ws://{napcat_host}:{napcat_port}/"
     try:
         async with websockets.connect(uri) as ws:
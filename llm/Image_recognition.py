@@ -1,46 +1,109 @@
-import hashlib
-import requests
-from openai import AsyncOpenAI
-import os
-import json
-from log import info
-
-async def 图片识别(链接:str,api_key:str,api_url:str,model_name:str)->str:
+import asyncio
+import re
+from typing import Awaitable, Callable, Dict, Optional
+from urllib.parse import urlparse, parse_qs
+from log import info, warning
+from llm.client_pool import get_client
+from llm.image_download import 下载图片
+from llm.image_preprocess import 压缩为数据链接
+from data.image_cache import get_cache
+from data.image_hash import 感知哈希
+
+# 正在进行的识别任务，相同图片的并发请求共享同一个任务（同一张图只下载、识别一次）
+_进行中: Dict[str, asyncio.Task] = {}
+
+
+def 提取图片标识(链接: str, 文件名: Optional[str] = None) -> Optional[str]:
+    """
+    从消息段的文件名或 QQ 图片链接中提取稳定的图片标识，用于下载前查询缓存。
+
+    链接里的 rkey 等签名参数每次都会变化，这里只取 fileid 或路径中的 MD5。
+    """
+    if 文件名:
+        return f"file:{文件名.lower()}"
+    try:
+        parsed = urlparse(链接)
+    except ValueError:
+        return None
+    fileid = parse_qs(parsed.query).get("fileid")
+    if fileid and fileid[0]:
+        return f"fileid:{fileid[0]}"
+    m = re.search(r"-([0-9A-Fa-f]{32})/", parsed.path)
+    if m:
+        return f"md5:{m.group(1).lower()}"
+    return None
+
+
+def _任务结束(键: str, task: asyncio.Task):
+    _进行中.pop(键, None)
+    if not task.cancelled():
+        task.exception()  # 所有调用方都已超时离开时，避免未读取异常的警告
+
+
+async def _合并请求(键: str, 工厂: Callable[[], Awaitable[str]]) -> str:
+    """同一个键同时只运行一个任务；调用方被取消时不影响共享任务继续完成并写入缓存。"""
+    task = _进行中.get(键)
+    if task is None:
+        task = asyncio.create_task(工厂())
+        _进行中[键] = task
+        task.add_done_callback(lambda t: _任务结束(键, t))
+    return await asyncio.shield(task)
+
+
+async def 图片识别(链接:str,api_key:str,api_url:str,model_name:str,文件名:Optional[str]=None)->str:
     """
     预处理
     """
-    # 下载图片
-    response = requests.get(链接)
-    if response.status_code != 200:
-        raise Exception("图片下载失败")
-    # 获取图片内容
-    image_content = response.content
-    # 计算图片的MD5哈希值
-    hash_md5 = hashlib.md5()
-    hash_md5.update(image_content)
-    image_hash = hash_md5.hexdigest()
-    # 读取缓存文件
-    cache_file = os.path.join(os.path.dirname(__file__), '..', 'data', 'Image_description_cache.txt')
-    cache = {}
-    if os.path.exists(cache_file):
-        try:
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                if os.path.getsize(cache_file) > 0:
-                    cache = json.load(f)
-                # else: cache remains {}
-        except json.JSONDecodeError:
-            # 如果 JSON 无效，初始化为空字典
-            cache = {}
-    if image_hash in cache:
-        info(f"图片识别缓存命中，图片描述为：{cache[image_hash]}")
-        return cache[image_hash]
+    cache = get_cache()
+    # 先按图片标识查询缓存，命中则完全跳过下载
+    标识 = 提取图片标识(链接, 文件名)
+    if 标识:
+        缓存描述 = cache.get_by_alias(标识)
+        if 缓存描述 is not None:
+            info(f"图片识别缓存命中(未下载)，图片描述为：{缓存描述}")
+            return 缓存描述
+        return await _合并请求(标识, lambda: _下载并识别(链接, api_key, api_url, model_name, 标识))
+    return await _下载并识别(链接, api_key, api_url, model_name, None)
+
+
+async def _下载并识别(链接:str,api_key:str,api_url:str,model_name:str,标识:Optional[str])->str:
+    # 异步流式下载图片，同时计算图片的MD5哈希值
+    image_content, image_hash = await 下载图片(链接)
+    # 查询图片描述缓存（内存 LRU + SQLite 索引）
+    cache = get_cache()
+    缓存描述 = cache.get(image_hash)
+    if 缓存描述 is None:
+        # 不同链接下载到相同内容时，同样只识别一次
+        缓存描述 = await _合并请求(f"hash:{image_hash}", lambda: _相似匹配或识别(链接, api_key, api_url, model_name, image_content, image_hash))
+    else:
+        info(f"图片识别缓存命中，图片描述为：{缓存描述}")
+    if 标识:
+        cache.put_alias(标识, image_hash)
+    return 缓存描述
+
+
+async def _相似匹配或识别(链接:str,api_key:str,api_url:str,model_name:str,image_content:bytes,image_hash:str)->str:
+    """MD5 未命中时先按感知哈希查找被重新压缩、缩放过的同一张图，仍未命中才调用图片模型。"""
+    phash = await asyncio.to_thread(感知哈希, image_content)
+    if phash is not None:
+        相似描述 = get_cache().find_similar(phash)
+        if 相似描述 is not None:
+            get_cache().put(image_hash, 相似描述, phash)
+            info(f"图片识别相似图片命中，图片描述为：{相似描述}")
+            return 相似描述
+    return await _调用图片模型(链接, api_key, api_url, model_name, image_content, image_hash, phash)
+
+
+async def _调用图片模型(链接:str,api_key:str,api_url:str,model_name:str,image_content:bytes,image_hash:str,phash:Optional[int]=None)->Optional[str]:
     """
     图片识别
     """
-    client = AsyncOpenAI(
-    api_key=api_key,
-    base_url=api_url,
-    )
+    client = get_client(api_url, api_key)
+    # 本地缩小后以 data URL 内联发送，省去模型服务再去 QQ 图床拉取原图；失败时回退为原链接
+    图片链接列表 = await asyncio.to_thread(压缩为数据链接, image_content) or [链接]
+    提示 = "请描写图片中的内容。若你认为这张图片可能是用于表达情绪的表情包，这时请着重输出他表达的情绪元素（其他的也要有，但是情绪元素至少有4点）。"
+    if len(图片链接列表) > 1:
+        提示 = f"以下{len(图片链接列表)}张图片是同一张动图按时间顺序截取的帧。" + 提示
 
     response = await client.chat.completions.create(
         model=model_name,
@@ -52,22 +115,23 @@ async def 图片识别(链接:str,api_key:str,api_url:str,model_name:str)->str:
             "content": [
                 {
                     "type": "text",
-                    "text": "请描写图片中的内容。若你认为这张图片可能是用于表达情绪的表情包，这时请着重输出他表达的情绪元素（其他的也要有，但是情绪元素至少有4点）。"
+                    "text": 提示
                 },
-                {
+                *[{
                     "type": "image_url",
                     "image_url": {
-                        "url":链接
+                        "url":图片链接
                     }
-                }
+                } for 图片链接 in 图片链接列表]
             ]
         }],
         stream=False
     )
     图片描述 = response.choices[0].message.content
+    if not 图片描述 or not 图片描述.strip():
+        warning("图片模型返回为空，保留[图片]占位")
+        return None
     # 写入缓存
-    cache[image_hash] = 图片描述
-    with open(cache_file, 'w', encoding='utf-8') as f:
-        json.dump(cache, f, ensure_ascii=False, indent=4)
+    get_cache().put(image_hash, 图片描述, phash)
     info(f"图片识别成功，图片描述为：{图片描述}")
-    return 图片描述
\ No newline at end of file
+    return 图片描述
@@ -0,0 +1,97 @@
+import asyncio
+import sys
+import os
+from typing import Dict, Optional, Tuple
+import httpx
+from openai import AsyncOpenAI
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from log import debug, info
+
+# 进程内共享的客户端，按 (base_url, api_key) 复用，避免每次调用都重新建立连接池、TLS 握手和 DNS 解析
+_clients: Dict[Tuple[str, str], AsyncOpenAI] = {}
+# 普通 HTTP 请求（如下载图片）共用的连接池
+_http_client: Optional[httpx.AsyncClient] = None
+
+_max_connections = 20
+_max_keepalive = 10
+_keepalive_expiry = 60.0
+_timeout = 30.0
+_connect_timeout = 5.0
+
+
+def configure(pool_config: dict) -> None:
+    """根据 bot_config.toml 的 [connection_pool] 段设置连接池参数，需在创建客户端前调用。"""
+    global _max_connections, _max_keepalive, _keepalive_expiry, _timeout, _connect_timeout
+    _max_connections = int(pool_config.get('最大连接数', _max_connections))
+    _max_keepalive = int(pool_config.get('保活连接数', _max_keepalive))
+    _keepalive_expiry = float(pool_config.get('保活秒数', _keepalive_expiry))
+    _timeout = float(pool_config.get('超时秒数', _timeout))
+    _connect_timeout = float(pool_config.get('连接超时秒数', _connect_timeout))
+
+
+def _new_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=_max_connections,
+            max_keepalive_connections=_max_keepalive,
+            keepalive_expiry=_keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(_timeout, connect=_connect_timeout),
+    )
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取共享的普通 HTTP 客户端，用于模型调用以外的请求。"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = _new_http_client()
+    return _http_client
+
+
+def get_client(base_url: str, api_key: str) -> AsyncOpenAI:
+    """获取 (base_url, api_key) 对应的共享客户端，不存在时创建。"""
+    key = (base_url, api_key)
+    client = _clients.get(key)
+    if client is None:
+        client = AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=_new_http_client(), timeout=_timeout)
+        _clients[key] = client
+    return client
+
+
+def _providers(adaptive_model_config: dict):
+    """从 ConfigLoader.get_adaptive_models 的结果中取出去重后的 (url, key)。"""
+    prefixes = ['回复模型', '判断模型']
+    if adaptive_model_config.get('图片模型_switch'):
+        prefixes.append('图片模型')
+    seen = []
+    for p in prefixes:
+        url = adaptive_model_config.get(f'{p}_url', '')
+        key = adaptive_model_config.get(f'{p}_key', '')
+        if url and key and (url, key) not in seen:
+            seen.append((url, key))
+    return seen
+
+
+async def warmup(adaptive_model_config: dict) -> None:
+    """启动时为每个 provider 预先建立连接，失败不影响正常运行。"""
+    async def _warm(url: str, key: str):
+        try:
+            await get_client(url, key).models.list(timeout=_connect_timeout + 5)
+            debug(f"已预热到 {url} 的连接")
+        except Exception as e:
+            debug(f"预热 {url} 失败: {e}")
+
+    providers = _providers(adaptive_model_config)
+    await asyncio.gather(*(_warm(url, key) for url, key in providers))
+    info(f"已预热 {len(providers)} 个模型服务的连接")
+
+
+async def close_all() -> None:
+    """关闭所有共享客户端及其连接池。"""
+    global _http_client
+    closers = [c.close() for c in _clients.values()]
+    _clients.clear()
+    if _http_client is not None:
+        closers.append(_http_client.aclose())
+        _http_client = None
+    await asyncio.gather(*closers, return_exceptions=True)
@@ -1,34 +1,79 @@
 import asyncio
+import re
 import sys
 import os
 import time
+from functools import lru_cache
+from typing import List, Tuple, Union
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from log import debug, info, warning
-from openai import AsyncOpenAI
 from pydantic.types import T
+from llm.client_pool import get_client
+from llm.prompt_builder import 记录缓存命中
+
+
+@lru_cache(maxsize=8)
+def 判断系统提示(bot_name: str, bot_Prompt: str) -> str:
+    """
+    判断模型的固定前缀（人设 + 评分标准），同一进程内逐字节不变，便于服务端前缀缓存。
+    聊天记录和本条消息放在后面单独的 user 消息里。
+    """
+    return (f"你叫{bot_name}，正在一个qq群里聊天，人设:\n{bot_Prompt}\n---\n"
+            "根据用户给出的消息记录和本条消息，评估你的回复兴趣度(0-10)。\n"
+            "评分标准：\n- 0-3: 无需回复(纯表情、私人对话等)\n- 4-6: 可选回复(一般闲聊)\n"
+            "- 7-8: 应该回复(直接提问、提及你)\n- 9-10: 必须回复(紧急情况、多次@你)\n"
+            "只输出一个数字，不要其他内容。")
+
+
+@lru_cache(maxsize=8)
+def 批量判断系统提示(bot_name: str, bot_Prompt: str) -> str:
+    """批量判断的固定前缀，评分标准与单条判断相同，要求按编号逐行输出分数。"""
+    return (f"你叫{bot_name}，正在一个qq群里聊天，人设:\n{bot_Prompt}\n---\n"
+            "根据用户给出的消息记录，分别评估你对每条编号消息的回复兴趣度(0-10)。\n"
+            "评分标准：\n- 0-3: 无需回复(纯表情、私人对话等)\n- 4-6: 可选回复(一般闲聊)\n"
+            "- 7-8: 应该回复(直接提问、提及你)\n- 9-10: 必须回复(紧急情况、多次@你)\n"
+            "每条消息输出一行，格式为“编号:分数”，不要其他内容。")
+
+
+def _调整兴趣(num_str: str, message: str, message_content: str, bot_name: str) -> Union[int, str]:
+    """把模型给出的分数取整，并按是否提起名字、消息长度调整。"""
+    提起名字 = bot_name in message
+    # 若为浮点数则向上取整
+    try:
+        if "@" in message_content and str(bot_name) in message_content:
+            message_content_len = int(len(message_content) - 10)
+        else:
+            message_content_len = len(message_content)
+        num_str = int(float(num_str) + 0.4)
+        if 提起名字:
+            info("提起名字,兴趣度+5")
+            num_str += 5
+        if int(num_str) >= 10:
+            num_str = 10
+        if message_content_len <= 5 and 提起名字 != True:
+            num_str -= (6 - message_content_len)
+        return int(num_str)
+    except ValueError:
+        return "error:1"
 
 async def llm_if(message: str, bot_name: str, bot_qq: int, url: str, key: str, model: str, message_content: str, bot_Prompt: str, 消息记录: str = ""):
     """使用 LLM 判断机器人对消息的兴趣度（0-10），并根据特定条件调整。"""
-    提起名字 = False
     if "@" in message and str(bot_name) in message:
         info("被@,兴趣度改为10")
         return int(10)
     else:
-        if bot_name in message:
-            提起名字 = True
         # 调用 LLM
-        client = AsyncOpenAI(
-            base_url=url,
-            api_key=key,
-        )
+        client = get_client(url, key)
         completion = await client.chat.completions.create(
             model=model,
             temperature=0.5,
             max_tokens=2,
             messages=[
-                {"role": "system", "content": f"你叫{bot_name}，消息记录:{消息记录}本条消息{message}根据消息内容和上下文，评估你的回复兴趣度(0-10)。\n评分标准：\n- 0-3: 无需回复(纯表情、私人对话等)\n- 4-6: 可选回复(一般闲聊)\n- 7-8: 应该回复(直接提问、提及你)\n- 9-10: 必须回复(紧急情况、多次@你)\n只输出一个数字，不要其他内容。"}
+                {"role": "system", "content": 判断系统提示(bot_name, bot_Prompt)},
+                {"role": "user", "content": f"消息记录:\n{消息记录}\n本条消息:{message}"}
             ]
         )
+        记录缓存命中(completion.usage, "判断")
         # 获取返回内容并处理
         content = completion.choices[0].message.content
         debug(f"判断模型返回内容: {content}")
@@ -37,24 +82,40 @@ async def llm_if(message: str, bot_name: str, bot_qq: int, url: str, key: str, m
         # 如果是空字符串，返回error:0
         if not num_str:
             return "error:0"
-        # 若为浮点数则向上取整
-        try:
-            if "@" in message_content and str(bot_name) in message_content:
-                message_content_len = int(len(message_content) - 10)
-            else:
-                message_content_len = len(message_content)
-            num_str = int(float(num_str) + 0.4)
-            if 提起名字:
-                info("提起名字,兴趣度+5")
-                num_str += 5
-            if int(num_str) >= 10:
-                num_str = 10
-            if message_content_len <= 5 and 提起名字 != True:
-                num_str -= (6 - message_content_len)
-            return int(num_str)
-        except ValueError:
-            return "error:1"
+        return _调整兴趣(num_str, message, message_content, bot_name)
     return 0
 
 
+_批量结果行 = re.compile(r"(\d+)\s*[:：.、]\s*(\d+(?:\.\d+)?)")
+
+
+async def llm_if_batch(messages: List[Tuple[str, str]], bot_name: str, url: str, key: str, model: str, bot_Prompt: str, 消息记录: str = "") -> List[Union[int, str]]:
+    """
+    一次请求判断同一个群里的多条消息，messages 为 (message, message_content) 列表，
+    返回与之一一对应的兴趣度，某条没有解析出分数时对应位置为 "error:0"。
+    """
+    编号列表 = "\n".join(f"{i}. {message}" for i, (message, _) in enumerate(messages, 1))
+    client = get_client(url, key)
+    completion = await client.chat.completions.create(
+        model=model,
+        temperature=0.5,
+        max_tokens=8 * len(messages),
+        messages=[
+            {"role": "system", "content": 批量判断系统提示(bot_name, bot_Prompt)},
+            {"role": "user", "content": f"消息记录:\n{消息记录}\n需要评估的消息:\n{编号列表}"}
+        ]
+    )
+    记录缓存命中(completion.usage, "判断")
+    content = completion.choices[0].message.content or ""
+    debug(f"批量判断模型返回内容: {content}")
+    分数表 = {int(i): s for i, s in _批量结果行.findall(content)}
+    results: List[Union[int, str]] = []
+    for i, (message, message_content) in enumerate(messages, 1):
+        if i not in 分数表:
+            results.append("error:0")
+        else:
+            results.append(_调整兴趣(分数表[i], message, message_content, bot_name))
+    return results
+
+
 
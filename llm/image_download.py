@@ -0,0 +1,53 @@
+import asyncio
+import hashlib
+import sys
+import os
+from typing import Tuple
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from llm.client_pool import get_http_client
+
+_max_bytes = 10 * 1024 * 1024
+_read_deadline = 8.0
+_CHUNK_SIZE = 64 * 1024
+
+
+class ImageDownloadError(Exception):
+    """图片下载失败、超过大小限制或超时。"""
+
+
+def configure(picture_config: dict) -> None:
+    """根据 [model.picture] 段设置下载的大小上限和读取期限。"""
+    global _max_bytes, _read_deadline
+    _max_bytes = int(picture_config.get('最大图片KB', _max_bytes // 1024)) * 1024
+    _read_deadline = float(picture_config.get('下载超时秒数', _read_deadline))
+
+
+async def 下载图片(链接: str) -> Tuple[bytes, str]:
+    """
+    以流式方式异步下载图片，边接收边计算 MD5。
+
+    复用共享连接池，不阻塞事件循环。超过大小上限或读取期限时立即中断下载，
+    内存占用不会超过大小上限。返回 (图片内容, MD5十六进制字符串)。
+    """
+    try:
+        async with asyncio.timeout(_read_deadline):
+            async with get_http_client().stream("GET", 链接) as response:
+                if response.status_code != 200:
+                    raise ImageDownloadError(f"图片下载失败，状态码 {response.status_code}")
+                declared = response.headers.get("content-length")
+                if declared and declared.isdigit() and int(declared) > _max_bytes:
+                    raise ImageDownloadError(f"图片大小 {declared} 字节超过上限 {_max_bytes} 字节")
+                hasher = hashlib.md5()
+                content = bytearray()
+                async for chunk in response.aiter_bytes(_CHUNK_SIZE):
+                    if len(content) + len(chunk) > _max_bytes:
+                        raise ImageDownloadError(f"图片大小超过上限 {_max_bytes} 字节")
+                    hasher.update(chunk)
+                    content += chunk
+    except TimeoutError:
+        raise ImageDownloadError(f"图片下载超过 {_read_deadline} 秒未完成")
+    except ImageDownloadError:
+        raise
+    except Exception as e:
+        raise ImageDownloadError(f"图片下载失败: {e}")
+    return bytes(content), hasher.hexdigest()
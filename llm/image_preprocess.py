@@ -0,0 +1,62 @@
+import base64
+import io
+import sys
+import os
+from typing import List
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from log import debug
+
+try:
+    from PIL import Image
+except ImportError:  # 未安装 pillow 时不做本地预处理，仍把原链接交给图片模型
+    Image = None
+
+_enabled = True
+_max_edge = 768
+_gif_frames = 3
+_jpeg_quality = 85
+
+
+def configure(picture_config: dict) -> None:
+    """根据 [model.picture] 段设置本地压缩参数。"""
+    global _enabled, _max_edge, _gif_frames, _jpeg_quality
+    _enabled = bool(picture_config.get('本地压缩', _enabled))
+    _max_edge = int(picture_config.get('最大边长', _max_edge))
+    _gif_frames = max(1, int(picture_config.get('动图采样帧数', _gif_frames)))
+    _jpeg_quality = int(picture_config.get('JPEG质量', _jpeg_quality))
+
+
+def _encode_frame(frame) -> str:
+    frame = frame.convert("RGBA")
+    background = Image.new("RGB", frame.size, (255, 255, 255))
+    background.paste(frame, mask=frame.getchannel("A"))
+    background.thumbnail((_max_edge, _max_edge), Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    background.save(buf, format="JPEG", quality=_jpeg_quality, optimize=True)
+    return "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+def 压缩为数据链接(image_content: bytes) -> List[str]:
+    """
+    把下载好的图片缩小到最大边长以内并重新编码为 JPEG data URL。
+
+    动图按时间均匀采样若干帧，每帧一个 data URL。未开启、未安装 pillow
+    或解码失败时返回空列表，调用方应回退为直接发送原链接。
+    该函数是 CPU 密集操作，应通过 asyncio.to_thread 调用。
+    """
+    if not _enabled or Image is None:
+        return []
+    try:
+        with Image.open(io.BytesIO(image_content)) as img:
+            n_frames = getattr(img, "n_frames", 1)
+            if n_frames <= 1 or _gif_frames == 1:
+                return [_encode_frame(img)]
+            count = min(_gif_frames, n_frames)
+            urls = []
+            for i in range(count):
+                img.seek(i * n_frames // count)
+                urls.append(_encode_frame(img))
+            return urls
+    except Exception as e:
+        debug(f"图片本地压缩失败，改为发送原链接: {e}")
+        return []
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from log import info, warning
+
+# 判断模型打分的样本（消息记录、本条消息、最终兴趣度），每行一条 JSON，供离线训练
+SAMPLES_FILENAME = "interest_samples.jsonl"
+MODEL_FILENAME = "interest_model.json"
+_DIM = 1 << 18
+
+
+def _data_path(filename: str) -> str:
+    return os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", filename)
+
+
+def 提取特征(消息记录: str, 消息: str) -> Dict[int, float]:
+    """
+    本条消息的字符 1~3-gram、上一条消息的字符 2-gram 和长度分档，哈希到固定维度。
+
+    使用 crc32 而不是内置 hash，保证训练和推理进程得到相同的下标。
+    """
+    features: Dict[int, float] = {}
+
+    def add(name: str, value: float = 1.0):
+        idx = zlib.crc32(name.encode("utf-8")) % _DIM
+        features[idx] = features.get(idx, 0.0) + value
+
+    text = 消息.strip()
+    for n in (1, 2, 3):
+        for i in range(len(text) - n + 1):
+            add(f"m{n}:{text[i:i + n]}")
+    lines = 消息记录.strip().splitlines()
+    previous = lines[-2] if len(lines) >= 2 else ""
+    previous = previous.split(": ", 1)[-1]
+    for i in range(len(previous) - 1):
+        add(f"c2:{previous[i:i + 2]}", 0.5)
+    add(f"len:{min(len(text), 64).bit_length()}")
+    # 按特征数归一化，避免长消息的分数被 n-gram 数量放大
+    scale = 1.0 / math.sqrt(max(1, len(features)))
+    return {k: v * scale for k, v in features.items()}
+
+
+class InterestModel:
+    """本地兴趣度线性模型：哈希 n-gram 特征的加权和加偏置，预测判断模型会给出的 0~10 分。"""
+
+    def __init__(self, weights: Optional[Dict[int, float]] = None, bias: float = 0.0, meta: Optional[dict] = None):
+        self.weights: Dict[int, float] = weights or {}
+        self.bias = bias
+        self.meta = meta or {}
+
+    def predict(self, 消息记录: str, 消息: str) -> float:
+        features = 提取特征(消息记录, 消息)
+        score = self.bias + sum(self.weights.get(k, 0.0) * v for k, v in features.items())
+        return min(10.0, max(0.0, score))
+
+    @classmethod
+    def train(cls, samples: List[Tuple[str, str, float]], epochs: int = 8,
+              lr: float = 0.1, l2: float = 1e-4, seed: int = 0) -> "InterestModel":
+        """用 SGD 最小化平方误差训练。"""
+        rng = random.Random(seed)
+        data = [(提取特征(ctx, msg), float(score)) for ctx, msg, score in samples]
+        bias = sum(score for _, score in data) / len(data) if data else 0.0
+        weights: Dict[int, float] = {}
+        for epoch in range(epochs):
+            rng.shuffle(data)
+            step = lr / (1 + epoch)
+            for features, target in data:
+                pred = bias + sum(weights.get(k, 0.0) * v for k, v in features.items())
+                err = pred - target
+                bias -= step * err * 0.1
+                for k, v in features.items():
+                    w = weights.get(k, 0.0)
+                    weights[k] = w - step * (err * v + l2 * w)
+        return cls({k: w for k, w in weights.items() if abs(w) > 1e-6}, bias)
+
+    def save(self, path: Optional[str] = None) -> None:
+        path = path or _data_path(MODEL_FILENAME)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"bias": self.bias, "weights": {str(k): round(w, 6) for k, w in self.weights.items()},
+                       "meta": self.meta}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Optional[str] = None) -> Optional["InterestModel"]:
+        path = path or _data_path(MODEL_FILENAME)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return cls({int(k): float(w) for k, w in data["weights"].items()}, float(data["bias"]), data.get("meta"))
+        except (OSError, ValueError, KeyError) as e:
+            warning(f"读取本地兴趣模型 {path} 失败: {e}")
+            return None
+
+
+def 读取样本(path: Optional[str] = None) -> List[Tuple[str, str, float]]:
+    path = path or _data_path(SAMPLES_FILENAME)
+    samples = []
+    if not os.path.exists(path):
+        return samples
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                samples.append((record["c"], record["m"], float(record["s"])))
+            except (ValueError, KeyError, TypeError):
+                continue
+    return samples
+
+
+def 评估(model: InterestModel, samples: Iterable[Tuple[str, str, float]], 阈值: float, 不确定带: float) -> dict:
+    """
+    对比本地模型与判断模型的打分。
+
+    返回平均绝对误差、回复/不回复决策的一致率，以及落在不确定带之外
+    （即线上不会调用判断模型）的样本比例和这部分样本上的一致率。
+    """
+    total = agree = confident = confident_agree = 0
+    abs_err = 0.0
+    for ctx, msg, score in samples:
+        pred = model.predict(ctx, msg)
+        total += 1
+        abs_err += abs(pred - score)
+        same = (pred >= 阈值) == (score >= 阈值)
+        agree += same
+        if abs(pred - 阈值) >= 不确定带:
+            confident += 1
+            confident_agree += same
+    return {
+        "样本数": total,
+        "平均绝对误差": round(abs_err / total, 3) if total else None,
+        "决策一致率": round(agree / total, 3) if total else None,
+        "跳过比例": round(confident / total, 3) if total else None,
+        "跳过部分一致率": round(confident_agree / confident, 3) if confident else None,
+    }
+
+
+# ---- 线上使用：加载模型、判断是否可跳过、记录样本 ----
+
+_model: Optional[InterestModel] = None
+_enabled = False
+_band = 2.5
+_记录样本 = True
+_待写样本: List[str] = []
+_写入任务: Optional[asyncio.Task] = None
+
+
+def configure(model_config: dict) -> None:
+    """根据 [interest_model] 段设置，开启时加载 data/interest_model.json。"""
+    global _model, _enabled, _band, _记录样本
+    _enabled = bool(model_config.get('开关', False))
+    _band = float(model_config.get('不确定带', _band))
+    _记录样本 = bool(model_config.get('记录样本', True))
+    _model = InterestModel.load() if _enabled else None
+    if _model is not None:
+        info(f"已加载本地兴趣模型，训练样本{_model.meta.get('样本数', '?')}条")
+
+
+def 本地打分(消息记录: str, 消息: str, 阈值: float) -> Optional[float]:
+    """本地分数离回复阈值足够远时返回分数，落在不确定带内或未启用时返回 None（需要调用判断模型）。"""
+    if _model is None:
+        return None
+    score = _model.predict(消息记录, 消息)
+    if abs(score - 阈值) < _band:
+        return None
+    return score
+
+
+def 记录样本(消息记录: str, 消息: str, 分数: int) -> None:
+    """记录一次判断模型的打分，攒够一批后在后台线程追加到样本文件。"""
+    global _写入任务
+    if not _记录样本:
+        return
+    _待写样本.append(json.dumps({"c": 消息记录, "m": 消息, "s": 分数, "t": int(time.time())}, ensure_ascii=False) + "\n")
+    if len(_待写样本) >= 20 and (_写入任务 is None or _写入任务.done()):
+        _写入任务 = asyncio.create_task(flush())
+
+
+def _append_lines(path: str, lines: List[str]) -> None:
+    with open(path, "a", encoding="utf-8") as f:
+        f.writelines(lines)
+
+
+async def flush() -> None:
+    if not _待写样本:
+        return
+    lines = _待写样本[:]
+    del _待写样本[:len(lines)]
+    try:
+        await asyncio.to_thread(_append_lines, _data_path(SAMPLES_FILENAME), lines)
+    except Exception as e:
+        warning(f"写入兴趣样本失败: {e}")
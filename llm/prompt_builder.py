@@ -0,0 +1,106 @@
+import sys
+import os
+from dataclasses import dataclass
+from typing import Optional, Sequence
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from log import debug
+import metrics
+
+try:
+    import tiktoken
+except ImportError:  # 未安装 tiktoken 时使用本地估算，中文按每字一个 token 计
+    tiktoken = None
+
+_省略标记 = "…(略)"
+_encoding = None
+_encoding_failed = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is None and tiktoken is not None and not _encoding_failed:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            _encoding_failed = True
+            debug(f"加载 tiktoken 编码失败，改用估算: {e}")
+    return _encoding
+
+
+def _估算(text: str) -> int:
+    """CJK 等非 ASCII 字符每个算 1 个 token，ASCII 字符每 4 个算 1 个。"""
+    wide = sum(1 for c in text if ord(c) > 0x7f)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def 计算token数(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return _估算(text)
+
+
+def 截断(text: str, 上限: int) -> str:
+    """把超过上限的文本截到上限以内，末尾加省略标记。"""
+    if 上限 <= 0 or 计算token数(text) <= 上限:
+        return text
+    可用 = 上限 - 计算token数(_省略标记)
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if 计算token数(text[:mid]) <= 可用:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo] + _省略标记
+
+
+@dataclass
+class 历史提示:
+    """按 token 预算拼好的聊天记录。"""
+    文本: str
+    token数: int
+    条数: int
+    截断条数: int = 0
+
+
+def 构建历史(条目: Sequence[str], 预算: int, 单条上限: Optional[int] = None) -> 历史提示:
+    """
+    从最新一条往前填充聊天记录，直到用完 token 预算，结果按时间顺序每条一行。
+
+    单条超过 单条上限 的消息先截断再计入预算；预算为 0 时不限制总长度。
+    """
+    选中 = []
+    总数 = 0
+    截断条数 = 0
+    for 原文 in reversed(条目):
+        文本 = 截断(原文, 单条上限) if 单条上限 else 原文
+        if 文本 is not 原文:
+            截断条数 += 1
+        token数 = 计算token数(文本) + 1  # 换行
+        if 预算 and 总数 + token数 > 预算:
+            break
+        选中.append(文本)
+        总数 += token数
+    选中.reverse()
+    return 历史提示("\n".join(选中), 总数, len(选中), 截断条数)
+
+
+def 缓存token数(usage) -> int:
+    """从 usage 中取出命中前缀缓存的 prompt token 数，兼容 OpenAI 和 DeepSeek 两种字段。"""
+    if usage is None:
+        return 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    if cached is None:
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    return int(cached or 0)
+
+
+def 记录缓存命中(usage, 名称: str) -> None:
+    """把一次调用的 prompt token 数和缓存命中率计入指标。"""
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    if not prompt_tokens:
+        return
+    metrics.observe(f"{名称}prompt_token", prompt_tokens)
+    metrics.observe(f"{名称}缓存命中率", round(缓存token数(usage) / prompt_tokens, 3))
@@ -1,98 +1,366 @@
 import asyncio
-from openai import AsyncOpenAI
 import websockets
 import json
 import sys
 import os
 import time
 import random
+from collections import deque
+from functools import lru_cache
+from typing import Deque, Dict, List, Optional, Tuple
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from log import info, warning
+from llm.client_pool import get_client
+from onebot import action_client
+from ratelimit import TokenBucket
+from llm.prompt_builder import 记录缓存命中
+import metrics
 
-# 全局变量用于频率限制和缓存验证
-last_call_time = 0
-message_cache = {}  # 用于缓存消息，防止重复发送
+# 全局变量用于缓存验证（回复频率由 scheduler.ReplyScheduler 按群控制）
+message_cache = {}  # 用于缓存消息，防止重复发送: (群号, 消息内容) -> 入队时间
 
 
-async def send_message_to_group(消息内容, 群号, napcat_host, napcat_port, websocket=None):
+async def send_message_to_group(消息内容, 群号, napcat_host, napcat_port, websocket=None) -> Optional[bool]:
+    """
+    立即发送一条群消息，一般应通过 outbound_queue 排队发送。
+
+    返回 True 表示确认发送成功，False 表示明确失败（可以重试），
+    None 表示请求已发出但等待响应超时，消息可能已经发出。
+    """
     # 验证参数有效性
     if not isinstance(群号, int) or 群号 <= 0:
         info(f"无效的群号: {群号}，跳过发送")
-        return
+        return False
 
     if not 消息内容 or not isinstance(消息内容, str):
         info(f"无效的消息内容，跳过发送")
-        return
+        return False
 
-    req = {
-        "action": "send_group_msg",
-        "params": {"group_id": 群号, "message": 消息内容},
-        "echo": "chat"
-    }
-    payload = json.dumps(req)
+    params = {"group_id": 群号, "message": 消息内容}
 
     try:
-        if websocket:
-            try:
-                await websocket.send(payload)
+        if action_client.connected:
+            # 通过主连接发送，并根据动作响应确认是否发送成功
+            resp = await action_client.call("send_group_msg", params)
+            if resp.get("status") == "ok":
                 info(f"成功发送消息到群{群号}: {消息内容} (复用WS)")
-                return
-            except Exception as e:
-                warning(f"复用WS发送失败，尝试新建连接: {e}")
-        
+                return True
+            warning(f"发送消息到群{群号}失败: {resp.get('wording') or resp.get('message') or resp.get('retcode')}")
+            return False
+
+        # 未运行主循环时（例如单独调用）才新建连接
+        payload = json.dumps({"action": "send_group_msg", "params": params, "echo": "chat"})
         uri = (f"ws://{napcat_host}:{napcat_port}/")
         async with websockets.connect(uri) as ws:
             await ws.send(payload)
             info(f"成功发送消息到群{群号}: {消息内容} (新建WS)")
+            return True
+    except asyncio.TimeoutError:
+        warning(f"发送消息到群{群号}等待响应超时，无法确认是否已发出")
+        return None
     except Exception as e:
-        info(f"发送消息失败: {e}")
+        info(f"发送消息失败: {e!r}")
+        return False
+
+
+class _待发送:
+    __slots__ = ("群号", "消息内容", "重试次数", "最早发送时间", "future")
+
+    def __init__(self, 群号: int, 消息内容: str, future: asyncio.Future):
+        self.群号 = 群号
+        self.消息内容 = 消息内容
+        self.重试次数 = 0
+        self.最早发送时间 = 0.0
+        self.future = future
+
+
+class OutboundQueue:
+    """
+    出站消息队列，由单独的写入任务按群轮流取出消息，每条消息在自己的任务中发送。
+
+    每个群一个令牌桶，速率贴合 QQ 的发言频率限制，突发回复会排队而不是触发风控；
+    一段时间内同一个群的相同内容只发送一次；明确失败（动作响应不是 ok 或连接出错）
+    按指数退避重试，等待响应超时的消息可能已经发出，不重试。
+    每个群同时只有一条消息在发送，保证群内顺序，某个群迟迟没有响应也不会耽误其他群。
+    enqueue() 不等待发送，返回的 Future 在确认送达或放弃后完成。
+    """
+
+    def __init__(self):
+        self._queues: Dict[int, Deque[_待发送]] = {}
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._order: List[int] = []
+        self._next_index = 0
+        self._sending: Dict[int, asyncio.Task] = {}  # 群号 -> 正在发送的任务
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._rate = 0.5
+        self._burst = 3
+        self._dedupe_window = 30.0
+        self._max_retries = 3
+        self._retry_delay = 1.0
+        self._napcat_host = ""
+        self._napcat_port = 0
+
+    def configure(self, send_config: dict, napcat_host: str, napcat_port: int) -> None:
+        """根据 [send] 段设置限速、去重和重试参数。"""
+        self._rate = float(send_config.get('每群每秒条数', self._rate))
+        self._burst = float(send_config.get('每群突发条数', self._burst))
+        self._dedupe_window = float(send_config.get('去重秒数', self._dedupe_window))
+        self._max_retries = int(send_config.get('最大重试次数', self._max_retries))
+        self._retry_delay = float(send_config.get('重试间隔秒数', self._retry_delay))
+        self._napcat_host = napcat_host
+        self._napcat_port = napcat_port
+        self._buckets.clear()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if not self.running:
+            self._task = asyncio.create_task(self._writer())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        sending = list(self._sending.values())
+        for task in sending:
+            task.cancel()
+        await asyncio.gather(*sending, return_exceptions=True)
+        self._sending.clear()
+        for queue in self._queues.values():
+            for item in queue:
+                if not item.future.done():
+                    item.future.set_result(False)
+        self._queues.clear()
+        self._order.clear()
+        self._next_index = 0
+
+    def enqueue(self, 群号: int, 消息内容: str) -> asyncio.Future:
+        """把消息放入队列，去重窗口内的重复消息直接丢弃（Future 结果为 False）。"""
+        future = asyncio.get_running_loop().create_future()
+        now = time.monotonic()
+        for key in [k for k, t in message_cache.items() if now - t >= self._dedupe_window]:
+            del message_cache[key]
+        if (群号, 消息内容) in message_cache:
+            info(f"群{群号}在{self._dedupe_window:.0f}秒内已发送过相同消息，跳过: {消息内容}")
+            future.set_result(False)
+            return future
+        message_cache[(群号, 消息内容)] = now
+        if 群号 not in self._queues:
+            self._queues[群号] = deque()
+            self._order.append(群号)
+        self._queues[群号].append(_待发送(群号, 消息内容, future))
+        self._wakeup.set()
+        return future
+
+    def _bucket(self, 群号: int) -> TokenBucket:
+        bucket = self._buckets.get(群号)
+        if bucket is None:
+            bucket = TokenBucket(self._rate, self._burst)
+            self._buckets[群号] = bucket
+        return bucket
+
+    def _drop_idle(self) -> None:
+        """移除已经发完、也没有消息在发送的群，轮询只遍历还有消息的群。"""
+        idle = [群号 for 群号 in self._order if not self._queues[群号] and 群号 not in self._sending]
+        if not idle:
+            return
+        current = self._order[self._next_index % len(self._order)]
+        for 群号 in idle:
+            del self._queues[群号]
+        self._order = [群号 for 群号 in self._order if 群号 in self._queues]
+        self._next_index = self._order.index(current) if current in self._queues else 0
+
+    def _next_ready(self) -> Tuple[Optional[_待发送], Optional[float]]:
+        """按群轮询取出下一条可以发送的消息；都不能发送时返回需要等待的秒数。"""
+        self._drop_idle()
+        now = time.monotonic()
+        wait: Optional[float] = None
+        n = len(self._order)
+        for i in range(n):
+            群号 = self._order[(self._next_index + i) % n]
+            queue = self._queues[群号]
+            # 上一条还在发送的群等它完成后再唤醒
+            if not queue or 群号 in self._sending:
+                continue
+            head = queue[0]
+            delay = max(head.最早发送时间 - now, self._bucket(群号).wait_time())
+            if delay <= 0 and self._bucket(群号).try_acquire():
+                self._next_index = (self._next_index + i + 1) % n
+                return queue.popleft(), None
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    async def _writer(self) -> None:
+        while True:
+            item, wait = self._next_ready()
+            if item is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(self._send(item))
+            self._sending[item.群号] = task
+            task.add_done_callback(lambda t, 群号=item.群号: self._sent(群号, t))
+
+    def _sent(self, 群号: int, task: asyncio.Task) -> None:
+        if self._sending.get(群号) is task:
+            del self._sending[群号]
+        self._wakeup.set()
+
+    async def _send(self, item: _待发送) -> None:
+        try:
+            ok = await send_message_to_group(item.消息内容, item.群号, self._napcat_host, self._napcat_port)
+        except asyncio.CancelledError:
+            if not item.future.done():
+                item.future.set_result(False)
+            raise
+        if ok:
+            item.future.set_result(True)
+        elif ok is None:
+            # 超时的消息可能已经发出，重试可能重复发言，保留去重记录并放弃
+            warning(f"发送到群{item.群号}未能确认送达，不再重试: {item.消息内容}")
+            item.future.set_result(False)
+        elif item.重试次数 < self._max_retries:
+            item.重试次数 += 1
+            delay = self._retry_delay * (2 ** (item.重试次数 - 1))
+            item.最早发送时间 = time.monotonic() + delay
+            self._queues[item.群号].appendleft(item)
+            warning(f"发送到群{item.群号}失败，{delay:.0f}秒后第{item.重试次数}次重试")
+        else:
+            warning(f"发送到群{item.群号}失败次数过多，放弃: {item.消息内容}")
+            message_cache.pop((item.群号, item.消息内容), None)
+            item.future.set_result(False)
+
+
+# 进程内共享的出站队列，由 bot.main 启动和停止
+outbound_queue = OutboundQueue()
+
+
+@lru_cache(maxsize=8)
+def 回复系统提示(bot名字: str, 提示词: str) -> str:
+    """回复模型的固定前缀，只依赖进程内不变的名字和人设，便于服务端前缀缓存。"""
+    return f"""你叫"{bot名字}"，你正在一个qq群里聊天，人设:{提示词}，不能换行!!!!!!!!，少用空格，回复尽量简短，只输出一句话。【注意：若你认为消息不应回复（例如：消息是纯表情、无意义内容或私人对话），请回复且只回复“0”】"""
+
+
+_句末 = "。！？!?"
+# “0”后跟这些字符时才算不回复，避免把“0.5倍速”“0点了”这类回复当成“0”
+_零后结束 = "。！？!?，,、~～…）)】」”\"'"
+
+
+def _首句结束位置(text: str, 最大字数: int) -> int:
+    """
+    返回第一行第一句话的结束位置，还没结束时返回 -1。
+
+    换行处一定结束；句末标点后紧跟文字（下一句开始）时在标点后结束，
+    标点后的颜文字等符号保留；超过最大字数时截断。
+    """
+    newline = text.find("\n")
+    if newline > 0:
+        return newline
+    for i, c in enumerate(text[:-1]):
+        if c in _句末 and text[i + 1].isalnum():
+            return i + 1
+    if 最大字数 and len(text) >= 最大字数:
+        return 最大字数
+    return -1
+
+
+async def _流式生成(client, 参数: dict, 最大字数: int) -> str:
+    """
+    流式读取回复，拿到第一句话或发现“0”（不回复）时立即停止，不再为丢弃的内容付费。
+
+    usage 只在读完整个流时才会返回，提前停止的调用不计入回复缓存命中率。
+    """
+    stream = await client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **参数)
+    content = ""
+    try:
+        async for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                记录缓存命中(chunk.usage, "回复")
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            content += delta
+            stripped = content.lstrip()
+            if len(stripped) >= 2 and stripped[0] == "0" and (stripped[1].isspace() or stripped[1] in _零后结束):
+                metrics.incr("回复提前结束")
+                return "0"
+            end = _首句结束位置(stripped, 最大字数)
+            if end >= 0:
+                metrics.incr("回复提前结束")
+                return stripped[:end].strip()
+    finally:
+        await stream.close()
+    return content.strip()
+
+
+def 含敏感词(消息: str, 人名: str) -> bool:
+    """消息里有试图改写提示词的关键词时不回复。"""
+    return "system" in 消息.lower() or "开发者模式" in 消息 and "x" not in 人名
+
+
+def 替换回复(content: str, 替换词, 被替换词) -> str:
+    """回复中出现替换词时整句换成随机一条被替换词。"""
+    # 检查替换词列表中是否有词出现在content中
+    if isinstance(替换词, (list, tuple)):
+        for word in 替换词:
+            if word in content:
+                if 被替换词 == "" or 被替换词 == " ":
+                    # raise ValueError("被替换词列表中存在空字符串或为空") 
+                    # 避免抛出异常导致bot崩溃，改为警告并跳过替换
+                    warning("被替换词列表中存在空字符串或为空，跳过替换")
+                else:
+                    content = random.choice(被替换词)
+    return content
 
 
 """
 使用llm发送消息
 """
-async def llm_send_message(消息历史, 那个人的名字, 单条完整消息, bot名字: str, 提示词: str, 群号: int, napcat_host: str, napcat_port: int, api_url: str, api_key: str, 模型: str, 是否发至群里: bool, 最大token: int, 替换词: str, 被替换词: str, websocket=None) -> str:
-    global last_call_time
-    if time.time() - last_call_time < 3:
-        info("消息发送频率过快，忽略")
-        return "0"
+async def llm_send_message(消息历史, 那个人的名字, 单条完整消息, bot名字: str, 提示词: str, 群号: int, napcat_host: str, napcat_port: int, api_url: str, api_key: str, 模型: str, 是否发至群里: bool, 最大token: int, 替换词: str, 被替换词: str, websocket=None, 流式: bool = False, 最大字数: int = 0) -> str:
+    """
+    调用回复模型生成一句回复，是否发至群里为 True 时同时发送。
 
-    if "system" in 单条完整消息.lower() or "开发者模式" in 单条完整消息 and "x" not in 那个人的名字:
+    返回 "0" 表示模型认为不应回复；流式为 True 时读到第一句话（或“0”）就停止生成。
+    """
+    if 含敏感词(单条完整消息, 那个人的名字):
         info("检测到敏感关键词，跳过发送")
         return "111111111"  # 配合bot.py的防误报机制实现不返回报错的功能
     
-    client = AsyncOpenAI(
-        base_url=api_url,
-        api_key=api_key,
-        timeout=30.0
-    )
-    completion = await client.chat.completions.create(
+    client = get_client(api_url, api_key)
+    参数 = dict(
         model=模型,
         max_tokens=最大token,
         messages=[
-            {"role": "system", "content": f"""你叫"{bot名字}"，你正在一个qq群里聊天，人设:{提示词}，不能换行!!!!!!!!，少用空格，回复尽量简短，只输出一句话。【注意：若你认为消息不应回复（例如：消息是纯表情、无意义内容或私人对话），请回复且只回复“0”】"""},
-            {"role": "user", "content": f"""消息历史:{消息历史},你要回复的消息：{单条完整消息}（他不一定在和你说话，请注意判断）"""}
+            {"role": "system", "content": 回复系统提示(bot名字, 提示词)},
+            {"role": "user", "content": f"""消息历史:\n{消息历史}\n你要回复的消息：{单条完整消息}（他不一定在和你说话，请注意判断）"""}
         ]
     )
-
-    # 获取返回内容并处理
-    content = completion.choices[0].message.content
+    if 流式:
+        content = await _流式生成(client, 参数, 最大字数)
+    else:
+        completion = await client.chat.completions.create(**参数)
+        记录缓存命中(completion.usage, "回复")
+        # 获取返回内容并处理
+        content = completion.choices[0].message.content
     if content is None or content == "" or content == " ":
         warning("llm返回为空")
         return "111111111"  # 配合bot.py的防误报机制实现不返回报错的功能
     
-    # 检查替换词列表中是否有词出现在content中
-    if isinstance(替换词, (list, tuple)):
-        for word in 替换词:
-            if word in content:
-                if 被替换词 == "" or 被替换词 == " ":
-                    # raise ValueError("被替换词列表中存在空字符串或为空") 
-                    # 避免抛出异常导致bot崩溃，改为警告并跳过替换
-                    warning("被替换词列表中存在空字符串或为空，跳过替换")
-                else:
-                    content = random.choice(被替换词)
-    
-    last_call_time = time.time()
+    content = 替换回复(content, 替换词, 被替换词)
+    if content.strip() == "0":
+        return "0"
     if 是否发至群里:
-        await send_message_to_group(content, 群号, napcat_host, napcat_port, websocket=websocket)
+        if outbound_queue.running:
+            outbound_queue.enqueue(群号, content)
+        else:
+            await send_message_to_group(content, 群号, napcat_host, napcat_port, websocket=websocket)
     return content
@@ -0,0 +1,48 @@
+import asyncio
+from typing import Dict, List
+
+from log import info
+
+# 进程内的简单指标：计数器和数值观测（次数、总和、最大值），定期输出到日志
+_计数器: Dict[str, int] = {}
+_观测: Dict[str, List[float]] = {}
+
+
+def incr(name: str, n: int = 1) -> None:
+    _计数器[name] = _计数器.get(name, 0) + n
+
+
+def observe(name: str, value: float) -> None:
+    stat = _观测.get(name)
+    if stat is None:
+        _观测[name] = [1, value, value]
+    else:
+        stat[0] += 1
+        stat[1] += value
+        stat[2] = max(stat[2], value)
+
+
+def snapshot() -> dict:
+    """返回当前全部指标，观测值给出次数、平均值和最大值。"""
+    result: dict = dict(_计数器)
+    for name, (count, total, peak) in _观测.items():
+        result[name] = {"次数": count, "平均": round(total / count, 2), "最大": peak}
+    return result
+
+
+def 摘要() -> str:
+    parts = []
+    for name, value in snapshot().items():
+        if isinstance(value, dict):
+            parts.append(f"{name}: 平均{value['平均']} 最大{value['最大']} ({value['次数']}次)")
+        else:
+            parts.append(f"{name}: {value}")
+    return "; ".join(parts)
+
+
+async def 定期输出(间隔秒数: float) -> None:
+    """每隔一段时间把指标摘要写入日志。"""
+    while True:
+        await asyncio.sleep(间隔秒数)
+        if _计数器 or _观测:
+            info(f"运行指标 {摘要()}")
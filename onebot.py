@@ -0,0 +1,86 @@
+import asyncio
+import itertools
+import json
+from typing import Dict, Optional
+
+from log import debug
+
+
+class OneBotActionClient:
+    """
+    在主 WebSocket 连接上复用发送 OneBot 动作请求的客户端。
+
+    每个请求带唯一的 echo，读取循环收到带 echo 的响应后调用 handle_response()
+    交给对应的 Future，因此查询昵称、发送消息都不需要再新建连接。
+    同时在途的请求数有上限，每次调用都有超时。
+    """
+
+    def __init__(self, max_in_flight: int = 16, timeout: float = 5.0):
+        self._websocket = None
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._counter = itertools.count(1)
+        self._max_in_flight = max(1, int(max_in_flight))
+        self._in_flight = asyncio.Semaphore(self._max_in_flight)
+        self._timeout = float(timeout)
+
+    def configure(self, onebot_config: dict) -> None:
+        """根据 [onebot] 段设置在途上限和默认超时，需在连接建立前调用。"""
+        self._max_in_flight = max(1, int(onebot_config.get('最大在途请求', self._max_in_flight)))
+        self._in_flight = asyncio.Semaphore(self._max_in_flight)
+        self._timeout = float(onebot_config.get('请求超时秒数', self._timeout))
+
+    @property
+    def connected(self) -> bool:
+        return self._websocket is not None
+
+    def bind(self, websocket) -> None:
+        """连接建立后绑定到主连接。"""
+        self._websocket = websocket
+
+    def unbind(self) -> None:
+        """连接断开时解绑，并让所有等待中的请求立即失败。"""
+        self._websocket = None
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("OneBot 连接已断开"))
+
+    def handle_response(self, data) -> bool:
+        """读取循环收到的数据如果是本客户端请求的响应，交给等待者并返回 True。"""
+        if not isinstance(data, dict) or "post_type" in data:
+            return False
+        echo = data.get("echo")
+        if not isinstance(echo, str):
+            return False
+        future = self._pending.pop(echo, None)
+        if future is None:
+            return False
+        if not future.done():
+            future.set_result(data)
+        return True
+
+    async def call(self, action: str, params: dict, timeout: Optional[float] = None) -> dict:
+        """
+        发送动作请求并等待响应，返回 OneBot 的响应字典（调用方自行检查 status）。
+
+        未连接时抛出 ConnectionError，超时抛出 asyncio.TimeoutError。
+        """
+        async with self._in_flight:
+            websocket = self._websocket
+            if websocket is None:
+                raise ConnectionError("OneBot 未连接")
+            echo = f"atbot:{action}:{next(self._counter)}"
+            future = asyncio.get_running_loop().create_future()
+            self._pending[echo] = future
+            try:
+                await websocket.send(json.dumps({"action": action, "params": params, "echo": echo}))
+                return await asyncio.wait_for(future, timeout or self._timeout)
+            except asyncio.TimeoutError:
+                debug(f"OneBot 动作 {action} 等待响应超时")
+                raise
+            finally:
+                self._pending.pop(echo, None)
+
+
+# 进程内共享的动作客户端，由 bot.main 在连接建立/断开时绑定和解绑
+action_client = OneBotActionClient()
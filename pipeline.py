@@ -0,0 +1,315 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from log import debug, warning, error
+from scheduler import ReplyScheduler
+import metrics
+
+
+@dataclass
+class GroupEvent:
+    """流水线中流转的一条群消息。"""
+    msg_type: str
+    content: str
+    group_id: int
+    sender_name: str
+    segments: List[Tuple[str, str, str]] = field(default_factory=list)
+    arrived_at: float = field(default_factory=time.monotonic)
+    priority: bool = False  # 直接@机器人的消息，由判断阶段设置，回复时走优先通道
+    sender_id: int = 0
+    burst_count: int = 1  # 合并进这条逻辑消息的原始消息条数
+    repeat_count: int = 1  # 在复读链中的位置，由预处理阶段设置，1 表示不是复读
+    speculative_reply: Optional[asyncio.Task] = None  # 与判断同时开始生成的回复，判断通过后直接使用
+    judge_seconds: float = 0.0  # 判断耗时，推测命中时用来计算节省的时间
+    speculative_tokens: int = 0  # 推测回复估算的 token 数（上下文加已生成的回复），没用上时计入浪费
+    interest: float = 0  # 判断阶段得出的兴趣度
+    seq: int = 0  # 在本群中的到达序号，由 submit() 设置
+    degraded: bool = False  # 积压时降级处理：不识别图片，闲聊只用本地判断
+    context_entry: Any = None  # 预处理阶段写入群聊上下文的记录，判断时只取到这条为止
+
+
+EnrichStage = Callable[[GroupEvent], Awaitable[Optional[GroupEvent]]]
+JudgeStage = Callable[[List[GroupEvent]], Awaitable[List[bool]]]
+ReplyStage = Callable[[GroupEvent], Awaitable[None]]
+
+
+class GroupPipeline:
+    """
+    按群分发的分阶段消息处理流水线。
+
+    读取协程只调用 submit() 把解析好的事件放入对应群的有界队列，
+    永远不会等待 LLM。每个群有一个独立的 worker 按顺序执行
+    enrich(@替换、写入上下文) -> judge(兴趣判断)，
+    判断通过后 reply 阶段以独立任务运行，不阻塞该群后续消息。
+    judge 每次接收一批事件：worker 取出一条后会顺带取出队列中已积压的消息，
+    并在 judge_batch_window 秒内继续等待新消息，最多凑满 judge_batch_size 条。
+    前两个阶段各自用信号量限制全局并发，reply 阶段由 ReplyScheduler 按群公平放行，
+    消息到达后超过 reply_deadline 秒仍未轮到的回复会被放弃。
+    同一发送者间隔不超过 debounce_gap 秒的连续文字消息在判断前合并为一条，
+    从第一条起最多等待 debounce_max_wait 秒；@机器人的消息不等待，并立即放出该发送者正在合并的消息。
+    进行中的回复按群登记：群里又来了超过 max_newer_messages 条消息或超过 reply_deadline
+    时取消；supersede 开启时，新的需要回复的消息会取代兴趣度不高于它的未完成回复。
+    过载时优先保证@机器人的消息（priority）：积压达到 degrade_depth 条或等待超过
+    degrade_age 秒的消息降级处理，积压达到 shed_depth 条时新到的闲聊直接丢弃，
+    等待超过 judge_deadline 秒的闲聊只写入上下文、不再判断。
+    """
+
+    def __init__(self, enrich: EnrichStage, judge: JudgeStage, reply: ReplyStage,
+                 scheduler: ReplyScheduler, *, queue_size: int = 50, enrich_concurrency: int = 4,
+                 judge_concurrency: int = 8, reply_deadline: float = 60.0,
+                 judge_batch_size: int = 1, judge_batch_window: float = 0.0,
+                 debounce_gap: float = 0.0, debounce_max_wait: float = 5.0,
+                 max_newer_messages: int = 0, supersede: bool = False,
+                 degrade_depth: int = 0, degrade_age: float = 0.0,
+                 shed_depth: int = 0, judge_deadline: float = 0.0):
+        self._enrich = enrich
+        self._judge = judge
+        self._reply = reply
+        self._scheduler = scheduler
+        self._queue_size = max(1, int(queue_size))
+        self._enrich_sem = asyncio.Semaphore(max(1, int(enrich_concurrency)))
+        self._judge_sem = asyncio.Semaphore(max(1, int(judge_concurrency)))
+        self._reply_deadline = float(reply_deadline)
+        self._judge_batch_size = max(1, int(judge_batch_size))
+        self._judge_batch_window = max(0.0, float(judge_batch_window))
+        self._debounce_gap = max(0.0, float(debounce_gap))
+        self._debounce_max_wait = max(self._debounce_gap, float(debounce_max_wait))
+        self._max_newer = max(0, int(max_newer_messages))
+        self._supersede = bool(supersede)
+        self._degrade_depth = max(0, int(degrade_depth))
+        self._degrade_age = max(0.0, float(degrade_age))
+        self._shed_depth = max(0, int(shed_depth))
+        self._judge_deadline = max(0.0, float(judge_deadline))
+        self._seq: Dict[int, int] = {}
+        self._inflight: Dict[int, Dict[asyncio.Task, GroupEvent]] = {}
+        self._queues: Dict[int, asyncio.Queue] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def submit(self, event: GroupEvent) -> bool:
+        """
+        非阻塞地投递事件，返回是否没有丢弃任何消息。
+
+        积压达到 shed_depth 或队列已满时丢弃新到的闲聊；@机器人的消息总是入队，
+        队列已满时改为丢弃该群最旧的一条消息。
+        """
+        self._seq[event.group_id] = event.seq = self._seq.get(event.group_id, 0) + 1
+        self._cancel_stale(event.group_id)
+        queue = self._queues.get(event.group_id)
+        if queue is None:
+            queue = asyncio.Queue(maxsize=self._queue_size)
+            self._queues[event.group_id] = queue
+            self._workers[event.group_id] = asyncio.create_task(self._worker(event.group_id, queue))
+        if not event.priority and (queue.full() or (self._shed_depth and queue.qsize() >= self._shed_depth)):
+            metrics.incr("丢弃闲聊")
+            debug(f"群{event.group_id}积压{queue.qsize()}条消息，丢弃新到的闲聊: {event.content}")
+            return False
+        dropped = False
+        if queue.full():
+            metrics.incr("丢弃最旧消息")
+            try:
+                queue.get_nowait()
+                queue.task_done()
+                dropped = True
+            except asyncio.QueueEmpty:
+                pass
+        queue.put_nowait(event)
+        if dropped:
+            warning(f"群{event.group_id}消息积压超过{self._queue_size}条，已丢弃最旧的消息")
+        return not dropped
+
+    def spawn(self, coro) -> asyncio.Task:
+        """创建受流水线管理的后台任务，关闭时一并取消。"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def is_stale(self, event: GroupEvent) -> bool:
+        """对话已经继续（新消息过多或超过截止时间）时，这条消息的回复不应再发出。"""
+        if self._max_newer and self._seq.get(event.group_id, 0) - event.seq > self._max_newer:
+            return True
+        return time.monotonic() > event.arrived_at + self._reply_deadline
+
+    def _cancel_stale(self, group_id: int) -> None:
+        for task, event in list(self._inflight.get(group_id, {}).items()):
+            if self.is_stale(event):
+                task.cancel()
+                metrics.incr("回复过时取消")
+
+    def _start_reply(self, event: GroupEvent) -> None:
+        if self.is_stale(event):
+            metrics.incr("回复过时取消")
+            self._drop_speculative(event)
+            return
+        inflight = self._inflight.setdefault(event.group_id, {})
+        if self._supersede:
+            for task, old in list(inflight.items()):
+                # 被@的回复不会被取代
+                if not old.priority and event.interest >= old.interest:
+                    task.cancel()
+                    metrics.incr("回复被取代")
+                    debug(f"群{event.group_id}的新消息取代了未完成的回复: {old.content}")
+        task = self.spawn(self._run_reply(event))
+        inflight[task] = event
+        task.add_done_callback(lambda t: inflight.pop(t, None))
+
+    def pending(self, group_id: int) -> int:
+        queue = self._queues.get(group_id)
+        return queue.qsize() if queue else 0
+
+    async def _collect(self, queue: asyncio.Queue, timeout: Optional[float] = None) -> List[GroupEvent]:
+        """
+        取出一批事件：先等第一条，再取积压的和窗口内新到的，最多 judge_batch_size 条。
+
+        timeout 秒内没有新消息时返回空列表，用于按时放出合并中的消息。
+        """
+        try:
+            batch = [await asyncio.wait_for(queue.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._judge_batch_window
+        while len(batch) < self._judge_batch_size:
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _worker(self, group_id: int, queue: asyncio.Queue):
+        # 合并中的消息: 发送者 -> [合并后的事件, 最后一条的到达时间]
+        bursts: Dict[int, list] = {}
+        while True:
+            timeout = None
+            if bursts:
+                now = time.monotonic()
+                timeout = max(0.0, min(self._burst_due(event, last) for event, last in bursts.values()) - now)
+            batch = await self._collect(queue, timeout)
+            try:
+                await self._process(batch, bursts)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error(f"处理群{group_id}消息出错: {e}")
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    def _burst_due(self, event: GroupEvent, last: float) -> float:
+        return min(last + self._debounce_gap, event.arrived_at + self._debounce_max_wait)
+
+    def _debounce(self, event: GroupEvent, bursts: Dict[int, list]) -> List[GroupEvent]:
+        """把文字消息并入该发送者正在合并的消息，返回现在就可以判断的事件。"""
+        if not self._debounce_gap or event.msg_type != "文字" or not event.sender_id:
+            return [event]
+        if event.priority:
+            # @机器人的消息不等待合并，该发送者之前的消息先放出，保持顺序
+            burst = bursts.pop(event.sender_id, None)
+            return [burst[0], event] if burst is not None else [event]
+        burst = bursts.get(event.sender_id)
+        if burst is None:
+            bursts[event.sender_id] = [event, event.arrived_at]
+            return []
+        merged = burst[0]
+        merged.content = f"{merged.content} {event.content}".strip()
+        merged.burst_count += 1
+        merged.priority = merged.priority or event.priority
+        merged.context_entry = event.context_entry or merged.context_entry
+        burst[1] = event.arrived_at
+        metrics.incr("合并消息")
+        return []
+
+    def _due_bursts(self, bursts: Dict[int, list]) -> List[GroupEvent]:
+        now = time.monotonic()
+        due = [sender for sender, (event, last) in bursts.items() if self._burst_due(event, last) <= now]
+        ready = [bursts.pop(sender)[0] for sender in due]
+        for event in ready:
+            if event.burst_count > 1:
+                debug(f"群{event.group_id}的{event.sender_name}连续{event.burst_count}条消息合并为: {event.content}")
+        return ready
+
+    def _admit(self, event: GroupEvent, depth: int) -> None:
+        """按积压条数和等待时间决定是否降级处理。"""
+        age = time.monotonic() - event.arrived_at
+        if (self._degrade_depth and depth >= self._degrade_depth) or (self._degrade_age and age >= self._degrade_age):
+            event.degraded = True
+            metrics.incr("降级处理")
+
+    def _judge_expired(self, event: GroupEvent) -> bool:
+        if event.priority or not self._judge_deadline:
+            return False
+        if time.monotonic() - event.arrived_at < self._judge_deadline:
+            return False
+        metrics.incr("判断过期跳过")
+        return True
+
+    async def _process(self, batch: List[GroupEvent], bursts: Dict[int, list]):
+        enriched_batch = []
+        depth = self.pending(batch[0].group_id) + len(batch) if batch else 0
+        for event in batch:
+            self._admit(event, depth)
+            async with self._enrich_sem:
+                enriched = await self._enrich(event)
+            if enriched is not None and self._judge_expired(enriched):
+                enriched = None
+            if enriched is not None:
+                enriched_batch.extend(e for e in self._debounce(enriched, bursts)
+                                      if e is enriched or not self._judge_expired(e))
+        enriched_batch.extend(event for event in self._due_bursts(bursts) if not self._judge_expired(event))
+        if not enriched_batch:
+            return
+        async with self._judge_sem:
+            decisions = await self._judge(enriched_batch)
+        for enriched, should_reply in zip(enriched_batch, decisions):
+            if should_reply:
+                self._start_reply(enriched)
+
+    @staticmethod
+    def _drop_speculative(event: GroupEvent) -> None:
+        """回复没有用上推测结果时（过时、被取代、超时或排队时被取消）计入浪费并取消仍在生成的推测回复。"""
+        if event.speculative_reply is None:
+            return
+        metrics.incr("推测浪费")
+        metrics.observe("推测浪费token", event.speculative_tokens)
+        if not event.speculative_reply.done():
+            event.speculative_reply.cancel()
+        event.speculative_reply = None
+
+    async def _run_reply(self, event: GroupEvent):
+        deadline = event.arrived_at + self._reply_deadline
+        try:
+            if not await self._scheduler.acquire(event.group_id, event.priority, deadline):
+                return
+            try:
+                async with asyncio.timeout(max(0.0, deadline - time.monotonic())):
+                    await self._reply(event)
+            except TimeoutError:
+                metrics.incr("回复过时取消")
+                warning(f"群{event.group_id}的回复超过{self._reply_deadline:.0f}秒仍未完成，已取消")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error(f"回复群{event.group_id}消息出错: {e}")
+            finally:
+                self._scheduler.release()
+        finally:
+            self._drop_speculative(event)
+
+    async def close(self):
+        """取消所有 worker 与后台任务。"""
+        tasks = list(self._workers.values()) + list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers.clear()
+        self._queues.clear()
+        self._tasks.clear()
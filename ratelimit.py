@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    令牌桶限速器。
+
+    以 rate 个/秒的速度补充令牌，最多积攒 capacity 个，允许短时间突发。
+    try_acquire() 不等待，wait_time() 给出还需等待的秒数，acquire() 会一直等到拿到令牌。
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = max(float(rate), 1e-9)
+        self.capacity = max(float(capacity), 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, n: float = 1) -> float:
+        self._refill()
+        if self._tokens >= n:
+            return 0.0
+        return (n - self._tokens) / self.rate
+
+    def try_acquire(self, n: float = 1) -> bool:
+        self._refill()
+        if self._tokens >= n:
+            self._tokens -= n
+            return True
+        return False
+
+    async def acquire(self, n: float = 1) -> None:
+        while not self.try_acquire(n):
+            await asyncio.sleep(self.wait_time(n))
@@ -0,0 +1,96 @@
+import re
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+_空白 = re.compile(r"\s+")
+_结尾标点 = re.compile(r"[!！?？。.,，~～…]+$")
+_链接 = re.compile(r"https?://|www\.", re.IGNORECASE)
+
+
+def 规范化(text: str) -> str:
+    """去掉多余空白和结尾标点并转为小写，"草！" 和 "草" 视为同一句。"""
+    text = _空白.sub(" ", text).strip().lower()
+    return _结尾标点.sub("", text) or text
+
+
+def 上下文指纹(上下文: Iterable[str], text: str, 条数: int = 2) -> int:
+    """取最近几条与本条不同的消息做粗粒度指纹，复读中的重复消息不影响指纹。"""
+    key = 规范化(text)
+    selected = []
+    for line in reversed(list(上下文)):
+        normalized = 规范化(line)
+        if normalized != key:
+            selected.append(normalized)
+            if len(selected) >= 条数:
+                break
+    return zlib.crc32("\n".join(selected).encode("utf-8"))
+
+
+def 适合跟读(text: str, 最大长度: int = 30) -> bool:
+    """带@、链接或过长的复读不跟读，避免替别人@人、转发链接或刷屏。"""
+    text = text.strip()
+    return bool(text) and len(text) <= 最大长度 and "@" not in text and not _链接.search(text)
+
+
+class RepeatTracker:
+    """
+    按群识别复读：连续多条规范化后相同、来自不同人的消息构成一条复读链。
+
+    observe() 返回当前消息在复读链中的位置（1 表示不是复读），
+    每条复读链机器人最多跟读一次。
+    """
+
+    def __init__(self):
+        # 群号 -> [规范化文本, 链长度, 已出现的发送者, 是否已跟读]
+        self._chains: Dict[int, list] = {}
+
+    def observe(self, 群号: int, 发送者: int, text: str) -> int:
+        key = 规范化(text)
+        chain = self._chains.get(群号)
+        if chain is None or chain[0] != key or not key:
+            self._chains[群号] = [key, 1, {发送者}, False]
+            return 1
+        if 发送者 not in chain[2]:
+            chain[2].add(发送者)
+            chain[1] += 1
+        return chain[1]
+
+    def try_join(self, 群号: int) -> bool:
+        """本条复读链尚未跟读时标记为已跟读并返回 True。"""
+        chain = self._chains.get(群号)
+        if chain is None or chain[3]:
+            return False
+        chain[3] = True
+        return True
+
+
+class JudgeScoreCache:
+    """以 (群号, 规范化文本, 上下文指纹) 为键的短期兴趣度缓存，按条数 LRU 淘汰并带过期时间。"""
+
+    def __init__(self, ttl: float = 300.0, max_size: int = 2048):
+        self._ttl = float(ttl)
+        self._max_size = max(1, int(max_size))
+        self._entries: "OrderedDict[Tuple[int, str, int], Tuple[float, float]]" = OrderedDict()
+
+    def get(self, 群号: int, text: str, 指纹: int) -> Optional[float]:
+        key = (群号, 规范化(text), 指纹)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        score, expires = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return score
+
+    def put(self, 群号: int, text: str, 指纹: int, score: float) -> None:
+        if self._ttl <= 0:
+            return
+        key = (群号, 规范化(text), 指纹)
+        self._entries[key] = (score, time.monotonic() + self._ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
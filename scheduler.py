@@ -0,0 +1,138 @@
+import asyncio
+import itertools
+import time
+from typing import Dict, List, Optional
+
+from log import info, debug
+from ratelimit import TokenBucket
+
+
+class _等待项:
+    __slots__ = ("群号", "优先", "完成标记", "截止时间", "序号", "future")
+
+    def __init__(self, 群号: int, 优先: bool, 完成标记: float, 截止时间: float, 序号: int, future: asyncio.Future):
+        self.群号 = 群号
+        self.优先 = 优先
+        self.完成标记 = 完成标记
+        self.截止时间 = 截止时间
+        self.序号 = 序号
+        self.future = future
+
+
+class ReplyScheduler:
+    """
+    回复模型调用的按群公平调度器。
+
+    每个群一个令牌桶限制回复频率，全局限制同时进行的回复数。
+    排队的回复在群之间按加权公平队列（WFQ）出队，直接@机器人的消息走优先通道，
+    总是排在普通闲聊之前。拿不到名额的回复排队等待而不是直接丢弃，
+    超过截止时间仍未轮到才放弃。
+    """
+
+    def __init__(self, concurrency: int = 4, rate: float = 0.2, burst: float = 2,
+                 weights: Optional[Dict[int, float]] = None):
+        self._concurrency = max(1, int(concurrency))
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._weights: Dict[int, float] = dict(weights or {})
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._last_finish: Dict[int, float] = {}
+        self._virtual_time = 0.0
+        self._waiting: List[_等待项] = []
+        self._active = 0
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def _bucket(self, 群号: int) -> TokenBucket:
+        bucket = self._buckets.get(群号)
+        if bucket is None:
+            bucket = TokenBucket(self._rate, self._burst)
+            self._buckets[群号] = bucket
+        return bucket
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._dispatcher())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for item in self._waiting:
+            if not item.future.done():
+                item.future.set_result(False)
+        self._waiting.clear()
+
+    async def acquire(self, 群号: int, 优先: bool = False, 截止时间: Optional[float] = None) -> bool:
+        """
+        排队等待一个回复名额，拿到返回 True，之后必须调用 release()。
+
+        截止时间为 time.monotonic() 时刻，超过时仍未轮到返回 False。
+        """
+        start = max(self._virtual_time, self._last_finish.get(群号, 0.0))
+        finish = start + 1.0 / max(self._weights.get(群号, 1.0), 1e-6)
+        self._last_finish[群号] = finish
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append(_等待项(群号, 优先, finish, 截止时间 or float("inf"), next(self._seq), future))
+        self._wakeup.set()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.result():
+                self.release()
+            else:
+                self._waiting = [item for item in self._waiting if item.future is not future]
+            raise
+
+    def release(self) -> None:
+        self._active -= 1
+        self._wakeup.set()
+
+    def _dispatch(self) -> Optional[float]:
+        """尽可能多地放行排队项，返回下一次需要检查的等待秒数（None 表示等待唤醒）。"""
+        now = time.monotonic()
+        wait: Optional[float] = None
+        for item in [item for item in self._waiting if item.截止时间 <= now]:
+            self._waiting.remove(item)
+            if not item.future.done():
+                item.future.set_result(False)
+            info(f"群{item.群号}的回复排队超过截止时间，已放弃")
+        while self._active < self._concurrency and self._waiting:
+            # 优先通道在前，同一通道内按 WFQ 完成标记、再按到达顺序
+            chosen = None
+            for item in sorted(self._waiting, key=lambda x: (not x.优先, x.完成标记, x.序号)):
+                delay = self._bucket(item.群号).wait_time()
+                if delay <= 0:
+                    chosen = item
+                    break
+                wait = delay if wait is None else min(wait, delay)
+            if chosen is None:
+                break
+            self._waiting.remove(chosen)
+            if chosen.future.done():
+                continue
+            self._bucket(chosen.群号).try_acquire()
+            self._virtual_time = max(self._virtual_time, chosen.完成标记 - 1.0 / max(self._weights.get(chosen.群号, 1.0), 1e-6))
+            self._active += 1
+            chosen.future.set_result(True)
+            debug(f"群{chosen.群号}的回复获得名额{'（优先）' if chosen.优先 else ''}，排队中{len(self._waiting)}条")
+        deadlines = [item.截止时间 for item in self._waiting if item.截止时间 != float("inf")]
+        if deadlines:
+            nearest = min(deadlines) - now
+            wait = nearest if wait is None else min(wait, nearest)
+        return None if wait is None else max(wait, 0.0)
+
+    async def _dispatcher(self) -> None:
+        while True:
+            self._wakeup.clear()
+            wait = self._dispatch()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,71 @@
+"""
+前缀缓存基准：用当前配置的判断模型和回复模型连续发送若干次请求，
+固定前缀相同、聊天记录不同，统计 usage 中命中缓存的 prompt token 比例和首 token 延迟。
+
+用法: python -m scripts.bench_prefix_cache [次数]
+"""
+import asyncio
+import sys
+import time
+
+from read_config import ConfigLoader
+from log import info, warning
+from llm.client_pool import get_client, close_all
+from llm.if_module import 判断系统提示
+from llm.send_message import 回复系统提示
+from llm.prompt_builder import 缓存token数
+
+
+async def _bench(名称: str, url: str, key: str, model: str, system: str, 次数: int, max_tokens: int):
+    client = get_client(url, key)
+    总prompt = 总缓存 = 0
+    首token延迟 = []
+    for i in range(次数):
+        user = f"消息记录:\n用户{i}: 今天第{i}次测试前缀缓存\n本条消息:用户{i}发了消息:在吗"
+        start = time.perf_counter()
+        first = None
+        usage = None
+        try:
+            stream = await client.chat.completions.create(
+                model=model, max_tokens=max_tokens, stream=True,
+                stream_options={"include_usage": True},
+                messages=[{"role": "system", "content": system}, {"role": "user", "content": user}],
+            )
+            async for chunk in stream:
+                if first is None and chunk.choices and chunk.choices[0].delta.content:
+                    first = time.perf_counter() - start
+                if chunk.usage is not None:
+                    usage = chunk.usage
+        except Exception as e:
+            warning(f"{名称}第{i + 1}次请求失败: {e}")
+            continue
+        if first is not None:
+            首token延迟.append(first)
+        if usage is not None:
+            总prompt += usage.prompt_tokens or 0
+            总缓存 += 缓存token数(usage)
+            info(f"{名称}#{i + 1}: prompt={usage.prompt_tokens} 缓存={缓存token数(usage)} 首token={first or 0:.3f}s")
+    比例 = 总缓存 / 总prompt if 总prompt else 0.0
+    平均延迟 = sum(首token延迟) / len(首token延迟) if 首token延迟 else 0.0
+    info(f"{名称}: 缓存命中率 {比例:.1%} ({总缓存}/{总prompt})，平均首token延迟 {平均延迟:.3f}s")
+
+
+async def main(次数: int):
+    loader = ConfigLoader()
+    data = loader.load_all(collect_errors=True)
+    bot = data['bot']
+    adaptive = data['adaptive']
+    personality = bot['personality']
+    提示词 = (f"# 核心人格\n{personality['personality_core']}\n---\n# 侧面人格\n{personality['personality_side']}\n---\n# 固定身份\n{personality['identity']}")
+    bot_name = bot['bot']['bot的名字']
+    try:
+        await _bench("判断模型", adaptive['判断模型_url'], adaptive['判断模型_key'], adaptive['判断模型_model'],
+                     判断系统提示(bot_name, 提示词), 次数, 2)
+        await _bench("回复模型", adaptive['回复模型_url'], adaptive['回复模型_key'], adaptive['回复模型_model'],
+                     回复系统提示(bot_name, 提示词), 次数, bot['model']['replyer_1']['maxtoken'])
+    finally:
+        await close_all()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5))
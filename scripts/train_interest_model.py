@@ -0,0 +1,56 @@
+"""
+用 data/interest_samples.jsonl 中记录的判断模型打分训练本地兴趣模型，
+输出验证集上的误差、一致率和可跳过比例，并保存到 data/interest_model.json。
+
+用法: python -m scripts.train_interest_model [--epochs N] [--dry-run]
+"""
+import argparse
+import random
+import time
+
+from read_config import load_bot_config
+from log import info, warning
+from llm.interest_model import InterestModel, 读取样本, 评估
+
+
+def main():
+    parser = argparse.ArgumentParser(description="训练本地兴趣模型")
+    parser.add_argument("--epochs", type=int, default=8)
+    parser.add_argument("--holdout", type=float, default=0.2, help="验证集比例")
+    parser.add_argument("--dry-run", action="store_true", help="只输出报告，不保存模型")
+    args = parser.parse_args()
+
+    bot = load_bot_config()
+    阈值 = bot['bot']['回复兴趣']
+    不确定带 = bot.get('interest_model', {}).get('不确定带', 2.5)
+
+    samples = 读取样本()
+    if len(samples) < 50:
+        warning(f"样本只有{len(samples)}条，至少需要50条")
+        return
+    random.Random(0).shuffle(samples)
+    n_holdout = max(1, int(len(samples) * args.holdout))
+    train, holdout = samples[n_holdout:], samples[:n_holdout]
+
+    start = time.perf_counter()
+    model = InterestModel.train(train, epochs=args.epochs)
+    info(f"训练完成: {len(train)}条样本, {len(model.weights)}个非零权重, 用时{time.perf_counter() - start:.1f}s")
+    report = 评估(model, holdout, 阈值, 不确定带)
+    info(f"验证集({len(holdout)}条): {report}")
+
+    start = time.perf_counter()
+    for ctx, msg, _ in holdout:
+        model.predict(ctx, msg)
+    info(f"单次打分平均 {(time.perf_counter() - start) / len(holdout) * 1e6:.0f}µs")
+
+    if args.dry_run:
+        return
+    # 用全部样本重新训练后保存
+    model = InterestModel.train(samples, epochs=args.epochs)
+    model.meta = {"样本数": len(samples), "训练时间": int(time.time()), "验证": report}
+    model.save()
+    info("已保存到 data/interest_model.json")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,25 @@
 import json
-from typing import Tuple, Optional, Any, Dict, List
+import re
+from typing import Tuple, Optional, Any, Dict, List, Union
 
 # 新增：工具函数拆分，降低 parse_msg 的圈复杂度
 
-def _safe_json_load(msg: str) -> Optional[Dict[str, Any]]:
+# 消息段: (类型, 内容, 文件名)。类型为 "文字" 时内容是文本（@ 以 "@QQ号" 形式并入文本），
+# 媒体类型时内容是链接（可能为空），文件名是消息段中的 file 字段，用于识别同一张图片
+Segment = Tuple[str, str, str]
+
+_MEDIA_TYPES = {
+    'image': '图片',
+    'record': '语音',
+    'voice': '语音',
+    'video': '视频',
+    'file': '文件'
+}
+
+
+def _safe_json_load(msg: Union[str, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if isinstance(msg, dict):
+        return msg
     try:
         return json.loads(msg)
     except Exception:
@@ -19,66 +35,92 @@ def _extract_sender_name(sender: Dict[str, Any]) -> str:
     return str(name)
 
 
-def _parse_array_segments(segments: List[Dict[str, Any]]) -> Tuple[str, str]:
-    media_types = {
-        'image': '图片',
-        'record': '语音',
-        'voice': '语音',
-        'video': '视频',
-        'file': '文件'
-    }
-    text_parts: List[str] = []
-    media_url = ''
+def _append_text(result: List[Segment], text: str):
+    """追加文本段，与前一个文本段相邻时合并。"""
+    if not text:
+        return
+    if result and result[-1][0] == "文字":
+        result[-1] = ("文字", result[-1][1] + text, "")
+    else:
+        result.append(("文字", text, ""))
+
+
+def _parse_array_segments(segments: List[Dict[str, Any]]) -> List[Segment]:
+    result: List[Segment] = []
     for seg in segments:
         t = (seg or {}).get("type")
         data = (seg or {}).get("data", {}) or {}
         if t == "text":
-            text_parts.append(str(data.get("text", "")))
+            _append_text(result, str(data.get("text", "")))
         elif t == "at":
             qq = data.get("qq")
             if qq:
-                text_parts.append(f"@{qq}")
+                _append_text(result, f"@{qq}")
         elif t == "face":
             pass
-        elif t in media_types:
-            if t == 'image':
-                media_url = data.get('url', '')
-            return media_types[t], media_url
-    return "文字", "".join(text_parts).strip()
-
-
-def _parse_raw_message(rm: str) -> Tuple[str, str]:
-    media_cq = {
-        '[CQ:image': '图片',
-        '[CQ:record': '语音',
-        '[CQ:voice': '语音',
-        '[CQ:video': '视频',
-        '[CQ:file': '文件'
-    }
-    for cq, msg_type in media_cq.items():
-        if cq in rm:
-            # 提取 url
-            url_start = rm.find('url=')
-            if url_start != -1:
-                url_end = rm.find(']', url_start)
-                if url_end != -1:
-                    url = rm[url_start + 4:url_end]
-                    return msg_type, url
-            return msg_type, ''
-    return "文字", rm
+        elif t in _MEDIA_TYPES:
+            url = data.get('url', '') if t == 'image' else ''
+            result.append((_MEDIA_TYPES[t], str(url or ''), str(data.get('file', '') or '')))
+    return result
+
+
+_CQ_PATTERN = re.compile(r"\[CQ:(\w+)((?:,[^\]]*)?)\]")
+
+
+def _cq_unescape(s: str) -> str:
+    return s.replace("&#44;", ",").replace("&#91;", "[").replace("&#93;", "]").replace("&amp;", "&")
+
+
+def _parse_raw_message(rm: str) -> List[Segment]:
+    result: List[Segment] = []
+    last = 0
+    for m in _CQ_PATTERN.finditer(rm):
+        _append_text(result, _cq_unescape(rm[last:m.start()]))
+        last = m.end()
+        t = m.group(1)
+        params: Dict[str, str] = {}
+        for item in m.group(2).split(",")[1:]:
+            if "=" in item:
+                k, v = item.split("=", 1)
+                params[k] = _cq_unescape(v)
+        if t == "at":
+            if params.get("qq"):
+                _append_text(result, f"@{params['qq']}")
+        elif t in _MEDIA_TYPES:
+            url = params.get("url", "") if t == "image" else ""
+            result.append((_MEDIA_TYPES[t], url, params.get("file", "")))
+    _append_text(result, _cq_unescape(rm[last:]))
+    return result
+
+
+def _summarize_segments(segments: List[Segment]) -> Tuple[str, str]:
+    """
+    由消息段得出 (消息类型, 消息内容)。
+
+    含文字的消息（包括图文混排）类型为 "文字"，内容为全部文本；
+    纯媒体消息的类型为第一个媒体段的类型，内容为空字符串。
+    """
+    text = "".join(seg[1] for seg in segments if seg[0] == "文字").strip()
+    if text:
+        return "文字", text
+    for seg in segments:
+        if seg[0] != "文字":
+            return seg[0], ""
+    return "文字", ""
 
 
 # 重构后的主函数：仅负责协调、返回结构
 
-def parse_msg(msg: str) -> Optional[Tuple[str, str, int, str]]:
+def parse_msg(msg: Union[str, Dict[str, Any]]) -> Optional[Tuple[str, str, int, str, List[Segment]]]:
     """
-    解析 OneBot/NapCat 的事件消息，提取用于后续逻辑的关键信息。
+    解析 OneBot/NapCat 的事件消息（原始 JSON 文本或已解码的字典），提取用于后续逻辑的关键信息。
 
-    返回: (消息类型, 消息内容, 群号, 人名)
-    - 消息类型: "文字" | "图片" | "语音" | "视频" | "文件" | "系统"
-    - 消息内容: 仅当消息类型为 "文字" 时返回文本内容，其它类型返回空字符串（上层会覆盖为占位符）
+    返回: (消息类型, 消息内容, 群号, 人名, 消息段)
+    - 消息类型: 含文字的消息（包括图文混排）为 "文字"，纯媒体消息为 "图片" | "语音" | "视频" | "文件"
+    - 消息内容: 消息中的全部文本，纯媒体消息为空字符串（上层会覆盖为占位符）
     - 群号: 群聊为 group_id，私聊则返回 user_id，用于日志展示
     - 人名: 优先 sender.card，其次 sender.nickname，再次 sender.user_id
+    - 消息段: 按原顺序排列的全部消息段，见 Segment
     """
     event = _safe_json_load(msg)
     if not event or not _is_message_event(event):
@@ -99,8 +141,9 @@ def parse_msg(msg: str) -> Optional[Tuple[str, str, int, str]]:
     raw_message = event.get("raw_message", "") or ""
 
     if isinstance(segments, list) and message_format == "array":
-        msg_type, content = _parse_array_segments(segments)
+        parsed_segments = _parse_array_segments(segments)
     else:
-        msg_type, content = _parse_raw_message(raw_message)
+        parsed_segments = _parse_raw_message(raw_message)
+    msg_type, content = _summarize_segments(parsed_segments)
 
-    return msg_type, content, group_id, name
\ No newline at end of file
+    return msg_type, content, group_id, name, parsed_segments
\ No newline at end of file